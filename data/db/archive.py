@@ -0,0 +1,178 @@
+from datetime import datetime, timedelta
+import struct
+import mmap
+import zlib
+import sys
+import os
+from array import array
+
+# Each archive file holds one device's readings for one UTC month as a series of
+# appended blocks, in time order. A block is a fixed header followed by two zlib-compressed
+# columns: int64 timestamp deltas (from the block's first_ts) and float64 values.
+BLOCK_MAGIC = b'DCA1'
+BLOCK_HEADER = struct.Struct('<4sIqqII')  # magic, count, first_ts, last_ts, ts_len, value_len
+FILE_SUFFIX = '.dca'
+EPOCH_NAIVE = datetime(1970, 1, 1)
+# Block size when a month's file is rewritten to merge in older rows
+MERGE_BLOCK_ROWS = 100000
+
+
+class ColumnArchive:
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+
+    def _device_dir(self, device_name):
+        return os.path.join(self.archive_dir, device_name.replace(os.sep, '_'))
+
+    def path(self, device_name, month):
+        return os.path.join(self._device_dir(device_name), month + FILE_SUFFIX)
+
+    def months(self, device_name):
+        device_dir = self._device_dir(device_name)
+        if not os.path.isdir(device_dir):
+            return []
+        return sorted(f[:-len(FILE_SUFFIX)] for f in os.listdir(device_dir) if f.endswith(FILE_SUFFIX))
+
+    def append(self, device_name, timestamps, values):
+        """Archive (ts, value) columns, sorted by ts, and return the timestamps the archive now holds of them.
+
+        Rows newer than everything in their month's file are appended as a new
+        block. Older ones (e.g. history imported after a retention run) are
+        merged in by rewriting that month's file, so files stay in time order.
+        A timestamp that is already archived keeps its archived value, so
+        re-archiving after an interrupted run never duplicates data.
+        """
+        stored = []
+        start = 0
+        while start < len(timestamps):
+            month = month_of(timestamps[start])
+            end = start
+            while end < len(timestamps) and month_of(timestamps[end]) == month:
+                end += 1
+
+            path = self.path(device_name, month)
+            last_ts = _last_ts(path)
+            if last_ts is None or timestamps[start] > last_ts:
+                self._append_block(path, timestamps[start:end], values[start:end])
+            else:
+                self._merge(path, timestamps[start:end], values[start:end])
+            stored.extend(timestamps[start:end])
+            start = end
+
+        return stored
+
+    def _append_block(self, path, timestamps, values):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'ab') as f:
+            # Drop any partial block left by a crash mid-append
+            f.truncate(_valid_length(path))
+            f.write(_encode_block(timestamps, values))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _merge(self, path, timestamps, values):
+        merged = dict(_read_file(path, None, None))
+        for ts, value in zip(timestamps, values):
+            merged.setdefault(ts, value)
+        rows = sorted(merged.items())
+
+        # Written aside and renamed over the original, so readers see the old file or the new one
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for start in range(0, len(rows), MERGE_BLOCK_ROWS):
+                block = rows[start:start + MERGE_BLOCK_ROWS]
+                f.write(_encode_block([ts for ts, _ in block], [value for _, value in block]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def read(self, device_name, since=None, until=None):
+        """Yield (ts, value) for a device in time order, between since and until (inclusive)."""
+        first_month = month_of(since) if since is not None else None
+        last_month = month_of(until) if until is not None else None
+        for month in self.months(device_name):
+            # File names sort by month, so only the files covering the window are opened
+            if (first_month is not None and month < first_month) or (last_month is not None and month > last_month):
+                continue
+            yield from _read_file(self.path(device_name, month), since, until)
+
+
+def month_of(ts):
+    month = EPOCH_NAIVE + timedelta(microseconds=ts)
+    return f'{month.year:04d}-{month.month:02d}'
+
+
+def _encode_block(timestamps, values):
+    first_ts = timestamps[0]
+    ts_data = zlib.compress(_to_bytes(array('q', (ts - first_ts for ts in timestamps))))
+    value_data = zlib.compress(_to_bytes(array('d', values)))
+    header = BLOCK_HEADER.pack(BLOCK_MAGIC, len(timestamps), first_ts, timestamps[-1],
+                               len(ts_data), len(value_data))
+    return header + ts_data + value_data
+
+
+def _last_ts(path):
+    headers = list(_iter_headers(path))
+    return headers[-1][1][3] if headers else None
+
+
+def _to_bytes(column):
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column.tobytes()
+
+
+def _from_bytes(typecode, data):
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+def _iter_headers(path, mapped=None):
+    # Yields (offset, header) for every complete block in the file
+    if mapped is None:
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield from _iter_headers(path, mapped)
+        return
+
+    offset = 0
+    while offset + BLOCK_HEADER.size <= len(mapped):
+        header = BLOCK_HEADER.unpack_from(mapped, offset)
+        block_end = offset + BLOCK_HEADER.size + header[4] + header[5]
+        if header[0] != BLOCK_MAGIC or block_end > len(mapped):
+            return
+        yield offset, header
+        offset = block_end
+
+
+def _valid_length(path):
+    length = 0
+    for offset, header in _iter_headers(path):
+        length = offset + BLOCK_HEADER.size + header[4] + header[5]
+    return length
+
+
+def _read_file(path, since, until):
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            for offset, (_, count, first_ts, last_ts, ts_len, value_len) in _iter_headers(path, mapped):
+                # Block headers carry their time range, so blocks outside the
+                # window are skipped without decompressing anything
+                if (since is not None and last_ts < since) or (until is not None and first_ts > until):
+                    continue
+                ts_start = offset + BLOCK_HEADER.size
+                deltas = _from_bytes('q', zlib.decompress(view[ts_start:ts_start + ts_len]))
+                values = _from_bytes('d', zlib.decompress(view[ts_start + ts_len:ts_start + ts_len + value_len]))
+                for delta, value in zip(deltas, values):
+                    ts = first_ts + delta
+                    if (since is None or ts >= since) and (until is None or ts <= until):
+                        yield ts, value
+        finally:
+            view.release()
@@ -0,0 +1,24 @@
+# usage: python3 backfill_rollups.py [-h] db_file
+#
+# Rebuilds the minute/hour/day rollup tables from device_data; buckets whose rows
+# are all in the archive are kept as they are. New rows keep the rollups current
+# by trigger, so this is only needed for history written before those triggers
+# existed (or to repair the rollups after manual edits).
+import sys
+import os
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+from db.database import DeviceDatabaseHandler
+import argparse
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the device data rollup tables.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("db_file", help="Path to device_data.db")
+
+    args = parser.parse_args()
+    config = vars(args)
+
+    db = DeviceDatabaseHandler(config['db_file'])
+    db.rebuild_rollups()
+    db.close()
+    print('Rollups rebuilt.')
@@ -1,32 +1,136 @@
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain, islice
 from zoneinfo import ZoneInfo
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+from db.archive import ColumnArchive
+from metrics.registry import METRICS
+import threading
 import sqlite3
 import logging
+import heapq
 import time
+import os
 
 TIME_FMT = "%Y-%m-%d %H:%M:%S.%f"
 TIME_ZONE = "America/New_York"
+SCHEMA_VERSION = 2
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
 
-class DeviceDatabaseHandler:
-    def __init__(self, db_filename, wal_mode=True):
+# Rollup table suffix -> bucket width in seconds, finest first
+ROLLUPS = {'minute': 60, 'hour': 3600, 'day': 86400}
+ROLLUP_COLUMNS = {'min': 'min_value', 'max': 'max_value', 'mean': 'sum_value / count', 'last': 'last_value'}
+
+# Each device's newest device_data row, for (re)building device_latest
+LATEST_VALUES = """
+    SELECT device_id, ts, value
+    FROM device_data
+    WHERE (device_id, ts) IN (SELECT device_id, (SELECT MAX(ts)
+                                                 FROM device_data AS newest
+                                                 WHERE newest.device_id = devices.device_id)
+                              FROM devices);
+    """
+
+# A (device, time) already written is left alone: replacing it would fire the
+# insert triggers again and count it twice in the rollups
+INSERT_ROW = "INSERT OR IGNORE INTO device_data (device_id, ts, value) VALUES (?,?,?)"
+INSERT_ERROR = "INSERT INTO device_errors (ts, device_id, error_trace) VALUES (?,?,?)"
+
+# Read-only connections map this much of the file and keep this many KiB of page cache
+READ_ONLY_MMAP_SIZE = 64 * 1024 * 1024
+READ_ONLY_CACHE_KIB = 8192
+
+# Connections inherited across a fork are parked here rather than closed, so the
+# child never finalizes a handle (and its file locks) that belongs to the parent
+_FORKED_CONNECTIONS = []
+
+
+class BatchedWrites:
+    """write_value() and batch() for a class with write_values(values, ts), shared by the handler and its async writer."""
+    def _init_batching(self):
+        # Readings collected by an open batch() rather than written immediately
+        self._batch = None
+        self._batch_depth = 0
+        self._batch_lock = threading.RLock()
+
+    def write_value(self, device_name, device_value):
+        with self._batch_lock:
+            if self._batch is not None:
+                self._batch.append((device_name, device_value))
+                return
+
+        self.write_values([(device_name, device_value)])
+
+    @contextmanager
+    def batch(self):
+        """Collect every write_value() made inside the block and pass them to write_values() once, on exit."""
+        with self._batch_lock:
+            if self._batch_depth == 0:
+                self._batch = []
+                self._batch_time = now_ts()
+            self._batch_depth += 1
+
+        try:
+            yield self
+        finally:
+            with self._batch_lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    values, self._batch = self._batch, None
+                    self.write_values(values, ts=self._batch_time)
+
+
+class DeviceDatabaseHandler(BatchedWrites):
+    def __init__(self, db_filename, wal_mode=True, persistent=True, archive_dir=None, read_only=False):
         self.db_filename = db_filename
-        self.conn = None
         self.wal_mode = wal_mode
-        self.init_db()
+        # Read-only handlers (the web server) open the file with mode=ro and
+        # query_only, and never run DDL, so they can't take write locks
+        self.read_only = read_only
+        # When persistent, each thread keeps one open connection for the life of
+        # the process instead of connecting (and re-issuing pragmas) per query
+        self.persistent = persistent
+        self._local = threading.local()
+        self._init_batching()
+        # device_name -> device_id, filled lazily from the devices table
+        self._device_ids = dict()
+        # Raw rows past the retention window live here, one file per device per month. The default
+        # is named after the database file (device_data.db -> device_data.archive/), so databases
+        # side by side in one directory never read each other's archived rows
+        self.archive = ColumnArchive(archive_dir or os.path.splitext(os.path.abspath(db_filename))[0] + '.archive')
+        if not read_only:
+            self.init_db()
 
     def __del__(self):
         self.close()
 
     def init_db(self):
+        self._rename_legacy_tables()
+        self._create_devices_table()
         self._create_device_data_table()
+        self._create_device_latest_table()
+        self._create_rollup_tables()
         self._create_device_errors_table()
+        self.execute_sql(query=f"PRAGMA user_version = {SCHEMA_VERSION};")
 
     @staticmethod
-    def _create_db_connection(db_filename, wal_mode=True):
+    def _create_db_connection(db_filename, wal_mode=True, read_only=False):
         conn = None
         try:
+            if read_only:
+                conn = sqlite3.connect(f'file:{quote(os.path.abspath(db_filename))}?mode=ro', uri=True)
+                conn.execute('pragma query_only=1;')
+                conn.execute(f'pragma mmap_size={READ_ONLY_MMAP_SIZE};')
+                conn.execute(f'pragma cache_size=-{READ_ONLY_CACHE_KIB};')
+                return conn
+
             conn = sqlite3.connect(db_filename)
+            # Only takes effect on a brand new database, so it has to come before
+            # the WAL pragma writes the header; see vacuum() for existing ones
+            conn.execute('pragma auto_vacuum=incremental;')
             if wal_mode:
                 conn.execute('pragma journal_mode=wal;')
                 conn.commit()
@@ -38,125 +142,769 @@ class DeviceDatabaseHandler:
             logging.error(f'Error in _create_db_connection: {e}')
             raise e
 
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid != os.getpid():
+            # We've been forked (e.g. gunicorn --preload), so reconnect in this process
+            _FORKED_CONNECTIONS.append(conn)
+            self._local.conn = conn = None
+        return conn
+
+    @conn.setter
+    def conn(self, conn):
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+
     def close(self):
         if self.conn is not None:
             self.conn.close()
             self.conn = None
 
-    def execute_sql(self, query=None, args=(), attempts=0, catch_errors=True, max_tries=3):
+    def _connect(self):
+        if self.conn is None:
+            self.conn = self._create_db_connection(db_filename=self.db_filename,
+                                                   wal_mode=self.wal_mode,
+                                                   read_only=self.read_only)
+        return self.conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the block as one BEGIN IMMEDIATE transaction on this thread's connection, which it yields.
+
+        Statements run directly on the connection, without execute_sql's
+        per-statement commit and retries; an exception rolls everything back.
+        """
+        self._check_writable()
+        conn = self._connect()
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        if not self.persistent:
+            self.close()
+        # Timed like execute_sql's statements, so writes through here (the async writer's) show in db_query_seconds
+        METRICS.observe('db_query_seconds', time.perf_counter() - start, statement='TRANSACTION')
+
+    def execute_sql(self, query=None, args=(), attempts=0, catch_errors=True, max_tries=3, many=False):
         if query is None:
             self.close()
             raise ValueError("No query passed.")
 
-        if self.conn is None:
-            self.conn = self._create_db_connection(db_filename=self.db_filename, 
-                                                   wal_mode=self.wal_mode)
-
+        self._connect()
+        start = time.perf_counter()
         if catch_errors:
+            cursor = None
             try:
                 cursor = self.conn.cursor()
-                cursor.execute(query, args)
+                if many:
+                    cursor.executemany(query, args)
+                else:
+                    cursor.execute(query, args)
                 self.conn.commit()
 
             except Exception as e:
-                # If DB may be locked, wait a second and try again
-                if attempts < max_tries:
+                # Start the retry from a fresh connection. The cursor has to go first:
+                # a connection closed under a live statement lingers, still holding its locks.
+                if cursor is not None:
+                    cursor.close()
+                self.close()
+                # If DB is locked, wait a second and try again; anything else (e.g. a missing
+                # table before the device loop has created the schema) won't fix itself
+                if attempts < max_tries and is_locked(e):
                     logging.warning('Exception encountered while attempting to execute SQL. Retrying...')
+                    METRICS.inc('db_query_retries_total')
                     time.sleep(attempts + 1)
-                    return self.execute_sql(query=query, args=args, attempts=attempts+1)
+                    return self.execute_sql(query=query, args=args, attempts=attempts+1, many=many)
                 raise e
         else:
             cursor = self.conn.cursor()
-            cursor.execute(query, args)
+            if many:
+                cursor.executemany(query, args)
+            else:
+                cursor.execute(query, args)
             self.conn.commit()
 
         results = cursor.fetchall()
-        self.close()
+        if not self.persistent:
+            self.close()
 
+        METRICS.observe('db_query_seconds', time.perf_counter() - start, statement=query.lstrip().split(None, 1)[0].upper())
         return results
 
+    def iter_sql(self, query, args=(), chunk_size=1000):
+        """Run a query and yield its results in lists of up to chunk_size rows, straight from the cursor."""
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute(query, args)
+            while True:
+                chunk = cursor.fetchmany(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            cursor.close()
+
+    def _table_columns(self, table_name):
+        return [row[1] for row in self.execute_sql(query=f"PRAGMA table_info({table_name});")]
+
+    def _rename_legacy_tables(self):
+        # v1 tables are keyed on a local-time text write_time. Move them aside so
+        # the v2 tables can take their names; db/migrate.py streams the rows over.
+        for table_name in ('device_data', 'device_errors'):
+            if 'write_time' in self._table_columns(table_name):
+                logging.warning(f'Found v1 {table_name} table, renaming it to {table_name}_v1. '
+                                'Run data/db/migrate.py to copy its rows into the v2 schema.')
+                self.execute_sql(query=f"ALTER TABLE {table_name} RENAME TO {table_name}_v1;")
+
+    def _create_devices_table(self):
+        table_def = """
+            CREATE TABLE IF NOT EXISTS devices (
+                    device_id integer PRIMARY KEY,
+                    device_name text NOT NULL UNIQUE
+            );
+            """
+        self.execute_sql(query=table_def)
+
     def _create_device_data_table(self):
+        # ts is UTC microseconds since the epoch. Rows are clustered by device,
+        # then time, so every per-device range read is a single b-tree seek.
         table_def = """
             CREATE TABLE IF NOT EXISTS device_data (
-                    write_time text PRIMARY KEY,
-                    device_name text NOT NULL,
+                    device_id integer NOT NULL,
+                    ts integer NOT NULL,
+                    value real NOT NULL,
+                    PRIMARY KEY (device_id, ts)
+            ) WITHOUT ROWID;
+            """
+        self.execute_sql(query=table_def)
+
+    def _create_device_latest_table(self):
+        # One row per device, kept current by a trigger so latest-value reads
+        # never touch the history in device_data
+        table_def = """
+            CREATE TABLE IF NOT EXISTS device_latest (
+                    device_id integer PRIMARY KEY,
+                    ts integer NOT NULL,
                     value real NOT NULL
             );
             """
+        trigger_def = """
+            CREATE TRIGGER IF NOT EXISTS device_latest_on_insert
+            AFTER INSERT ON device_data
+            BEGIN
+                INSERT INTO device_latest (device_id, ts, value)
+                VALUES (NEW.device_id, NEW.ts, NEW.value)
+                ON CONFLICT (device_id) DO UPDATE
+                SET ts = excluded.ts, value = excluded.value
+                WHERE excluded.ts >= device_latest.ts;
+            END;
+            """
         self.execute_sql(query=table_def)
+        self.execute_sql(query=trigger_def)
+        # Seed any device whose rows predate the trigger
+        self.execute_sql(query="INSERT OR IGNORE INTO device_latest (device_id, ts, value) " + LATEST_VALUES)
+
+    def rebuild_latest(self):
+        """Recompute device_latest from device_data.
+
+        Devices with no rows left in device_data (all archived) keep their entry.
+        """
+        self._check_writable()
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO device_latest (device_id, ts, value) " + LATEST_VALUES)
+
+    def _create_rollup_tables(self):
+        # Per-device min/max/sum/count/last for each minute, hour and day (UTC
+        # buckets, keyed on bucket start), folded in by a trigger as rows land
+        for resolution, seconds in ROLLUPS.items():
+            width = seconds * 1000000
+            table_def = f"""
+                CREATE TABLE IF NOT EXISTS device_rollup_{resolution} (
+                        device_id integer NOT NULL,
+                        bucket integer NOT NULL,
+                        min_value real NOT NULL,
+                        max_value real NOT NULL,
+                        sum_value real NOT NULL,
+                        count integer NOT NULL,
+                        last_ts integer NOT NULL,
+                        last_value real NOT NULL,
+                        PRIMARY KEY (device_id, bucket)
+                ) WITHOUT ROWID;
+                """
+            trigger_def = f"""
+                CREATE TRIGGER IF NOT EXISTS device_rollup_{resolution}_on_insert
+                AFTER INSERT ON device_data
+                BEGIN
+                    INSERT INTO device_rollup_{resolution}
+                        (device_id, bucket, min_value, max_value, sum_value, count, last_ts, last_value)
+                    VALUES (NEW.device_id, NEW.ts - NEW.ts % {width}, NEW.value, NEW.value, NEW.value, 1, NEW.ts, NEW.value)
+                    ON CONFLICT (device_id, bucket) DO UPDATE
+                    SET min_value = min(min_value, excluded.min_value),
+                        max_value = max(max_value, excluded.max_value),
+                        sum_value = sum_value + excluded.sum_value,
+                        count = count + 1,
+                        last_ts = max(last_ts, excluded.last_ts),
+                        last_value = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last_value ELSE last_value END;
+                END;
+                """
+            self.execute_sql(query=table_def)
+            self.execute_sql(query=trigger_def)
+
+    def rebuild_rollups(self):
+        """Recompute the rollups, e.g. for rows written before the rollup triggers existed.
+
+        Only buckets from the day holding each device's oldest device_data row
+        onwards are rebuilt, with archived rows in that range folded back in.
+        Older buckets cover archived rows only, and are kept as they are. It
+        all runs in one transaction, so live writes can't land in between a
+        bucket being deleted and recomputed.
+        """
+        self._check_writable()
+        devices = self.execute_sql(query="SELECT device_id, device_name FROM devices")
+        with self.transaction() as conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS rollup_archived (ts integer PRIMARY KEY, value real NOT NULL);")
+            for device_id, device_name in devices:
+                oldest = conn.execute("SELECT min(ts) FROM device_data WHERE device_id = ?", (device_id,)).fetchone()[0]
+                if oldest is None:
+                    continue
+                # A day bucket start is a minute and hour bucket start too
+                start = bucket_start(oldest, ROLLUPS['day'])
+                conn.execute("DELETE FROM temp.rollup_archived;")
+                conn.executemany("INSERT OR IGNORE INTO temp.rollup_archived (ts, value) VALUES (?,?)",
+                                 self.archive.read(device_name, since=start))
+
+                for resolution, seconds in ROLLUPS.items():
+                    width = seconds * 1000000
+                    conn.execute(f"DELETE FROM device_rollup_{resolution} WHERE device_id = ? AND bucket >= ?",
+                                 (device_id, start))
+                    # Rows an interrupted retention run left in both places count once
+                    query = f"""
+                            WITH source AS (
+                                SELECT ts, value
+                                FROM device_data
+                                WHERE device_id = ?1
+                                AND ts >= ?2
+                                UNION ALL
+                                SELECT ts, value
+                                FROM temp.rollup_archived
+                                WHERE NOT EXISTS (SELECT 1
+                                                  FROM device_data
+                                                  WHERE device_id = ?1
+                                                  AND ts = rollup_archived.ts)
+                            ),
+                            buckets AS (
+                                SELECT ts - ts % {width} AS bucket, min(value) AS min_value, max(value) AS max_value,
+                                       sum(value) AS sum_value, count(*) AS count, max(ts) AS last_ts
+                                FROM source
+                                GROUP BY 1
+                            )
+
+                            INSERT INTO device_rollup_{resolution}
+                                (device_id, bucket, min_value, max_value, sum_value, count, last_ts, last_value)
+                            SELECT ?1, buckets.*, source.value
+                            FROM buckets
+                            JOIN source
+                            ON source.ts = buckets.last_ts
+                            """
+                    conn.execute(query, (device_id, start))
+            conn.execute("DELETE FROM temp.rollup_archived;")
+
+    def import_rows(self, rows, chunk_size=100000):
+        """Bulk-load an iterable of (ts, device_name, value) rows, ts in UTC epoch microseconds.
+
+        Rows go in as chunk_size-row transactions with the insert triggers
+        dropped and synchronous off; device_latest and the rollups are rebuilt
+        in one pass at the end. Returns the number of rows loaded.
+        """
+        self._check_writable()
+        synchronous = self.execute_sql(query="PRAGMA synchronous;")[0][0]
+        self.execute_sql(query="PRAGMA synchronous = OFF;")
+        self._drop_insert_triggers()
+
+        imported = 0
+        rows = iter(rows)
         try:
-            self.execute_sql(query="CREATE INDEX device_name_idx ON device_data(device_name);", catch_errors=False)
-            self.execute_sql(query="CREATE INDEX value_idx ON device_data(value);", catch_errors=False)
-        except sqlite3.OperationalError:
-            # Indexes already exist
-            pass
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                self.write_rows(chunk)
+                imported += len(chunk)
+
+        finally:
+            self.execute_sql(query=f"PRAGMA synchronous = {synchronous};")
+            self._create_device_latest_table()
+            self._create_rollup_tables()
+            self.rebuild_latest()
+            self.rebuild_rollups()
+
+        return imported
+
+    def _drop_insert_triggers(self):
+        self.execute_sql(query="DROP TRIGGER IF EXISTS device_latest_on_insert;")
+        for resolution in ROLLUPS:
+            self.execute_sql(query=f"DROP TRIGGER IF EXISTS device_rollup_{resolution}_on_insert;")
+
+    def apply_retention(self, keep_days, chunk_size=50000):
+        """Move device_data rows older than keep_days into the column archive, then free their pages.
+
+        Rollups and device_latest are left alone, so long-range aggregate reads
+        are unaffected. Returns the number of rows archived.
+        """
+        self._check_writable()
+        cutoff = now_ts() - int(float(keep_days) * 86400 * 1000000)
+        archived = 0
+        for device_id, device_name in self.execute_sql(query="SELECT device_id, device_name FROM devices"):
+            while True:
+                query = """SELECT ts, value
+                           FROM device_data
+                           WHERE device_id = ?
+                           AND ts < ?
+                           ORDER BY ts
+                           LIMIT ?
+                           """
+                rows = self.execute_sql(query=query, args=(device_id, cutoff, chunk_size))
+                if not rows:
+                    break
+                # Archive first, then delete only what the archive says it holds: an
+                # interrupted run leaves rows in both places, and reads dedupe them
+                stored = self.archive.append(device_name, [ts for ts, _ in rows], [value for _, value in rows])
+                self.execute_sql(query="DELETE FROM device_data WHERE device_id = ? AND ts = ?",
+                                 args=[(device_id, ts) for ts in stored], many=True)
+                archived += len(stored)
+
+        if archived:
+            self.vacuum()
+        return archived
+
+    def vacuum(self, full=False):
+        """Release free pages with an incremental vacuum.
+
+        Databases created before auto_vacuum was enabled need one full VACUUM
+        (full=True) to switch over; it rewrites the whole file, so it is never
+        done implicitly.
+        """
+        self._check_writable()
+        if self.execute_sql(query="PRAGMA auto_vacuum;")[0][0] != 2:
+            if not full:
+                logging.warning('Incremental vacuum is not enabled for this database. '
+                                'Run data/db/retention.py --vacuum once to enable it.')
+                return
+            self.execute_sql(query="PRAGMA auto_vacuum = INCREMENTAL;")
+            self.execute_sql(query="VACUUM;")
+
+        # Run as a script: stepped once through execute() it frees a single page
+        self._connect().executescript("PRAGMA incremental_vacuum;")
 
     def _create_device_errors_table(self):
         table_def = """
             CREATE TABLE IF NOT EXISTS device_errors (
-                    write_time text PRIMARY KEY,
-                    device_name text NOT NULL,
+                    error_id integer PRIMARY KEY,
+                    ts integer NOT NULL,
+                    device_id integer NOT NULL,
                     error_trace text
             );
             """
         self.execute_sql(query=table_def)
+        self.execute_sql(query="CREATE INDEX IF NOT EXISTS device_errors_ts_idx ON device_errors(ts);")
+
+    def schema_ready(self):
+        """Whether the database exists and has the current schema, which read-only handlers can't create."""
         try:
-            self.execute_sql(query="CREATE INDEX device_name_idx ON device_data(device_name);", catch_errors=False)
+            return self.execute_sql(query="PRAGMA user_version;")[0][0] >= SCHEMA_VERSION
         except sqlite3.OperationalError:
-            # Indexes already exist
-            pass
+            return False
 
-    def write_value(self, device_name, device_value):
-        write_time = datetime.now(ZoneInfo(TIME_ZONE)).strftime(TIME_FMT)
-        query = "INSERT INTO device_data (write_time, device_name, value) VALUES (?,?,?)"
-        _ = self.execute_sql(query=query, args=(write_time, device_name, device_value))
+    def _check_writable(self):
+        if self.read_only:
+            raise PermissionError(f'{self.db_filename} was opened read-only.')
 
-    def write_error(self, device_name, error_trace):
-        write_time = datetime.now(ZoneInfo(TIME_ZONE)).strftime(TIME_FMT)
-        query = "INSERT INTO device_errors (write_time, device_name, error_trace) VALUES (?,?,?)"
-        _ = self.execute_sql(query=query, args=(write_time, device_name, error_trace))
+    def device_id(self, device_name, create=True):
+        device_id = self._device_ids.get(device_name)
+        if device_id is None:
+            if create and not self.read_only:
+                self.execute_sql(query="INSERT OR IGNORE INTO devices (device_name) VALUES (?)",
+                                 args=(device_name,))
+            found = self.execute_sql(query="SELECT device_id FROM devices WHERE device_name = ?",
+                                     args=(device_name,))
+            if not found:
+                return None
+            device_id = self._device_ids[device_name] = found[0][0]
+        return device_id
+
+    def write_values(self, values, ts=None):
+        """Write [(device_name, value), ...] in a single transaction, all sharing one timestamp.
+
+        ts is UTC epoch microseconds, and defaults to now. See stamp_values for
+        a device written more than once.
+        """
+        ts = ts if ts is not None else now_ts()
+        self.write_rows(stamp_values(values, ts))
+
+    def write_rows(self, rows):
+        """Write [(ts, device_name, value), ...] in a single transaction."""
+        self._check_writable()
+        if not rows:
+            return
+
+        rows = [(self.device_id(device_name), ts, device_value) for ts, device_name, device_value in rows]
+        _ = self.execute_sql(query=INSERT_ROW, args=rows, many=True)
+
+    def write_error(self, device_name, error_trace, ts=None):
+        self._check_writable()
+        ts = ts if ts is not None else now_ts()
+        _ = self.execute_sql(query=INSERT_ERROR, args=(ts, self.device_id(device_name), error_trace))
+
+    def write_rows_and_errors(self, rows, errors):
+        """Write [(ts, device_name, value), ...] and [(device_name, error_trace, ts), ...] in one transaction.
+
+        Unlike write_rows, nothing is retried here: on an exception none of it
+        was written, so the caller can retry the whole lot.
+        """
+        self._check_writable()
+        # Resolved before BEGIN, since registering a new device commits on its own
+        rows = [(self.device_id(device_name), ts, device_value) for ts, device_name, device_value in rows]
+        errors = [(ts, self.device_id(device_name), error_trace) for device_name, error_trace, ts in errors]
+        with self.transaction() as conn:
+            if rows:
+                conn.executemany(INSERT_ROW, rows)
+            if errors:
+                conn.executemany(INSERT_ERROR, errors)
+
+    def change_token(self):
+        """Cheap value that changes whenever a new reading lands (newest device_latest time and device count)."""
+        newest, devices = self.execute_sql(query="SELECT max(ts), count(*) FROM device_latest")[0]
+        return f'{newest}-{devices}'
+
+    def newest_ts(self):
+        """Newest reading's time in UTC epoch microseconds, or 0 for an empty database."""
+        return self.execute_sql(query="SELECT coalesce(max(ts), 0) FROM device_latest")[0][0]
+
+    def read_all_after(self, ts, device_names=None, limit=-1, raw_ts=False):
+        """Rows newer than ts (UTC epoch microseconds), oldest first, for cursor-style polling.
+
+        Each device's (device_id, ts) key range is seeked directly, so this stays
+        cheap however much history there is. At most limit rows are returned.
+        """
+        if device_names is None:
+            device_names = self.device_names()
+        device_ids = [self.device_id(device_name, create=False) for device_name in device_names]
+        device_ids = [device_id for device_id in device_ids if device_id is not None]
+        if not device_ids:
+            return []
+
+        query = f"""
+                SELECT device_data.ts, devices.device_name, device_data.value
+                FROM device_data
+                JOIN devices
+                ON devices.device_id = device_data.device_id
+                WHERE device_data.device_id IN ({','.join('?' * len(device_ids))})
+                AND device_data.ts > ?
+                ORDER BY 1
+                LIMIT ?
+                """
+        rows = self.execute_sql(query=query, args=(*device_ids, ts, limit))
+        return rows if raw_ts else fmt_rows(rows)
+
+    def read_errors_after(self, error_id, limit=-1):
+        """(error_id, ts, device_name, error_trace) for errors logged after error_id, oldest first."""
+        query = """
+                SELECT device_errors.error_id, device_errors.ts, devices.device_name, device_errors.error_trace
+                FROM device_errors
+                JOIN devices
+                ON devices.device_id = device_errors.device_id
+                WHERE device_errors.error_id > ?
+                ORDER BY device_errors.error_id
+                LIMIT ?
+                """
+        return self.execute_sql(query=query, args=(error_id, limit))
+
+    def newest_error_id(self):
+        return self.execute_sql(query="SELECT coalesce(max(error_id), 0) FROM device_errors")[0][0]
 
     def read_device_latest(self, device_name):
-        query = """SELECT DISTINCT write_time, device_name, value 
-                   FROM device_data 
-                   WHERE device_name = ? 
-                   AND write_time = (SELECT MAX(write_time) 
-                                     FROM device_data 
-                                     WHERE device_name = ?)
+        query = """SELECT ts, ?, value
+                   FROM device_latest
+                   WHERE device_id = ?
                    """
-        return self.execute_sql(query=query, args=(device_name, device_name))
+        return self._read_device(query, device_name)
 
     def read_device_since(self, device_name, since):
-        query = """SELECT DISTINCT write_time, device_name, value 
-                   FROM device_data 
-                   WHERE device_name = ? 
-                   AND write_time >= ?
-                   ORDER BY 1
+        query = """SELECT ts, ?, value
+                   FROM device_data
+                   WHERE device_id = ?
+                   AND ts >= ?
+                   ORDER BY ts
                    """
-        return self.execute_sql(query=query, args=(device_name, since))
+        return self._read_device(query, device_name, to_ts(since))
 
-    def read_all_latest(self):
+    def read_all_latest(self, raw_ts=False):
         query = """
-                WITH latest_times AS (
-                    SELECT device_name, MAX(write_time) AS last_write_time
-                    FROM device_data
-                    GROUP BY 1
-                )
+                SELECT device_latest.ts, devices.device_name, device_latest.value
+                FROM device_latest
+                JOIN devices
+                ON devices.device_id = device_latest.device_id
+                ORDER BY 1
+                """
+        rows = self.execute_sql(query=query)
+        return rows if raw_ts else fmt_rows(rows)
 
-                SELECT DISTINCT device_data.write_time, device_data.device_name, device_data.value
+    def read_all_since(self, since):
+        # The IN list lets SQLite seek each device's (device_id, ts) range
+        # instead of scanning the whole table
+        query = """
+                SELECT device_data.ts, devices.device_name, device_data.value
                 FROM device_data
-                JOIN latest_times
-                ON device_data.device_name = latest_times.device_name
-                AND device_data.write_time = latest_times.last_write_time
+                JOIN devices
+                ON devices.device_id = device_data.device_id
+                WHERE device_data.device_id IN (SELECT device_id FROM devices)
+                AND device_data.ts >= ?
                 ORDER BY 1
                 """
-        return self.execute_sql(query=query)
+        return fmt_rows(self.execute_sql(query=query, args=(to_ts(since),)))
 
-    def read_all_since(self, since):
+    def iter_device_since(self, device_name, since, until=None, chunk_size=1000, chunks=False, raw_ts=False):
+        """Streaming read_device_since: yields rows (or lists of chunk_size rows) without building the full result.
+
+        With raw_ts, write_time is left as UTC epoch microseconds.
+        """
+        device_id = self.device_id(device_name, create=False)
+        if device_id is None:
+            return iter(())
+
+        query = """SELECT ts, ?, value
+                   FROM device_data
+                   WHERE device_id = ?
+                   AND ts >= ? AND ts <= ?
+                   ORDER BY ts
+                   """
+        args = (device_name, device_id, to_ts(since), to_ts(until) if until is not None else now_ts())
+        return _fmt_chunks(self.iter_sql(query=query, args=args, chunk_size=chunk_size), chunks, raw_ts)
+
+    def iter_all_since(self, since, until=None, chunk_size=1000, chunks=False, raw_ts=False):
+        """Streaming read_all_since: yields rows (or lists of chunk_size rows) without building the full result.
+
+        With raw_ts, write_time is left as UTC epoch microseconds.
+        """
         query = """
-                SELECT DISTINCT write_time, device_name, value
+                SELECT device_data.ts, devices.device_name, device_data.value
                 FROM device_data
-                WHERE write_time >= ?
+                JOIN devices
+                ON devices.device_id = device_data.device_id
+                WHERE device_data.device_id IN (SELECT device_id FROM devices)
+                AND device_data.ts >= ? AND device_data.ts <= ?
                 ORDER BY 1
                 """
-        return self.execute_sql(query=query, args=(since,))
+        args = (to_ts(since), to_ts(until) if until is not None else now_ts())
+        return _fmt_chunks(self.iter_sql(query=query, args=args, chunk_size=chunk_size), chunks, raw_ts)
+
+    def read_history(self, since, until=None, device_names=None):
+        """Read rows from the column archive and device_data, merged in time order.
+
+        Use this rather than read_all_since for ranges that may reach past the
+        raw retention window. Same (write_time, device_name, value) shape.
+        """
+        return list(self.iter_history(since, until=until, device_names=device_names))
+
+    def iter_history(self, since, until=None, device_names=None, chunk_size=1000, raw_ts=False):
+        """Streaming read_history: yields rows one at a time from the archive files and live cursors.
+
+        With raw_ts, write_time is left as UTC epoch microseconds.
+        """
+        start = to_ts(since)
+        end = to_ts(until) if until is not None else now_ts()
+        if device_names is None:
+            device_names = self.device_names()
+
+        merged = self._iter_history(start, end, device_names, chunk_size)
+        if raw_ts:
+            yield from merged
+            return
+        for ts, device_name, value in merged:
+            yield fmt_ts(ts), device_name, value
+
+    def _iter_history(self, start, end, device_names, chunk_size=1000):
+        # (ts, device_name, value) from the archive and device_data, in time order, between epoch-µs start and end
+        streams = []
+        for device_name in device_names:
+            device_id = self.device_id(device_name, create=False)
+            if device_id is None:
+                continue
+            query = """SELECT ts, ?, value
+                       FROM device_data
+                       WHERE device_id = ?
+                       AND ts >= ? AND ts <= ?
+                       ORDER BY ts
+                       """
+            live = chain.from_iterable(self.iter_sql(query=query, args=(device_name, device_id, start, end),
+                                                     chunk_size=chunk_size))
+            streams.append(_unique_ts(heapq.merge(self._read_archive(device_name, start, end), live)))
+        return heapq.merge(*streams)
+
+    def _read_archive(self, device_name, start, end):
+        for ts, value in self.archive.read(device_name, start, end):
+            yield ts, device_name, value
+
+    def device_names(self):
+        return [name for (name,) in self.execute_sql(query="SELECT device_name FROM devices ORDER BY device_name")]
+
+    def read_device_series(self, device_name, since, until=None, max_points=1000, agg='mean', resolution=None,
+                           raw_ts=False):
+        """Read one device's values between since and until, at no more than max_points points.
+
+        Raw rows are returned when they fit the budget; otherwise the finest
+        rollup (minute, hour, then day) that fits, with agg ('min', 'max',
+        'mean' or 'last') picking the value reported for each bucket, timed at
+        the bucket start. Pass resolution ('raw' or a ROLLUPS name) to skip the
+        choice; the earliest max_points rows at that resolution are returned.
+        Same (write_time, device_name, value) shape as the other read methods,
+        with write_time left as UTC epoch microseconds when raw_ts is set.
+        """
+        start = to_ts(since)
+        end = to_ts(until) if until is not None else now_ts()
+        device_id = self.device_id(device_name, create=False)
+        if device_id is None:
+            return []
+
+        limit = max_points
+        if resolution is None:
+            resolution = self._pick_resolution(device_id, start, end, max_points)
+            limit = -1
+
+        if resolution == 'raw':
+            # Raw rows past the retention window live in the archive, so read both like iter_history
+            rows = self._iter_history(start, end, [device_name])
+            rows = list(islice(rows, limit) if limit >= 0 else rows)
+        else:
+            query = f"""SELECT bucket, ?, {ROLLUP_COLUMNS[agg]}
+                        FROM device_rollup_{resolution}
+                        WHERE device_id = ?
+                        AND bucket >= ? AND bucket <= ?
+                        ORDER BY bucket
+                        LIMIT ?
+                        """
+            rows = self.execute_sql(query=query, args=(device_name, device_id,
+                                                       bucket_start(start, ROLLUPS[resolution]), end, limit))
+        return rows if raw_ts else fmt_rows(rows)
+
+    def pick_resolution(self, device_name, since, until=None, max_points=1000):
+        """The resolution read_device_series would pick: 'raw' or the finest ROLLUPS name within max_points."""
+        device_id = self.device_id(device_name, create=False)
+        if device_id is None:
+            return 'raw'
+        return self._pick_resolution(device_id, to_ts(since), to_ts(until) if until is not None else now_ts(),
+                                     max_points)
+
+    def _pick_resolution(self, device_id, start, end, max_points):
+        # Returns 'raw' when the raw rows fit, else the finest rollup that does
+        query = """SELECT coalesce(sum(count), 0)
+                   FROM device_rollup_minute
+                   WHERE device_id = ?
+                   AND bucket >= ? AND bucket <= ?
+                   """
+        args = (device_id, bucket_start(start, ROLLUPS['minute']), end)
+        if self.execute_sql(query=query, args=args)[0][0] <= max_points:
+            return 'raw'
+
+        for resolution, seconds in ROLLUPS.items():
+            query = f"""SELECT count(*)
+                        FROM device_rollup_{resolution}
+                        WHERE device_id = ?
+                        AND bucket >= ? AND bucket <= ?
+                        """
+            args = (device_id, bucket_start(start, seconds), end)
+            if self.execute_sql(query=query, args=args)[0][0] <= max_points:
+                return resolution
+        return resolution
+
+    def _read_device(self, query, device_name, *args):
+        device_id = self.device_id(device_name, create=False)
+        if device_id is None:
+            return []
+        return fmt_rows(self.execute_sql(query=query, args=(device_name, device_id) + args))
+
+
+def is_locked(error):
+    """Whether error is SQLite's database locked/busy error, the only kind worth retrying."""
+    # sqlite3 only exposes the result code in the message ("database is locked", "... busy")
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def now_ts():
+    """Current time as UTC microseconds since the epoch."""
+    return time.time_ns() // 1000
+
+
+def stamp_values(values, ts):
+    """Timestamp [(device_name, value), ...] written together as [(ts, device_name, value), ...].
+
+    Each repeat write of a device lands 1 microsecond after the previous one,
+    so e.g. a solenoid opened and closed in one batch keeps both rows rather
+    than one replacing the other on the (device_id, ts) key.
+    """
+    repeats = dict()
+    rows = []
+    for device_name, value in values:
+        offset = repeats.get(device_name, 0)
+        repeats[device_name] = offset + 1
+        rows.append((ts + offset, device_name, value))
+    return rows
+
+
+def _unique_ts(rows):
+    # One device's rows in time order, dropping a row with the same ts as the one before:
+    # a retention run interrupted between archiving and deleting leaves the row in both places
+    last_ts = None
+    for row in rows:
+        if row[0] != last_ts:
+            yield row
+        last_ts = row[0]
+
+
+def to_ts(when):
+    """Convert a datetime, TIME_FMT string or epoch seconds to UTC epoch microseconds.
+
+    Naive datetimes and strings are taken to be in TIME_ZONE.
+    """
+    if isinstance(when, (int, float)):
+        return int(when * 1000000)
+    if isinstance(when, str):
+        when = datetime.fromisoformat(when)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=ZoneInfo(TIME_ZONE))
+    return (when - EPOCH) // ONE_MICROSECOND
+
+
+def bucket_start(ts, seconds):
+    """Start of the seconds-wide bucket holding ts, in epoch microseconds."""
+    return ts - ts % (seconds * 1000000)
+
+
+@lru_cache(maxsize=4096)
+def _utc_offset(hour):
+    # TIME_ZONE only changes offset on the hour, so cache one lookup per UTC hour
+    return datetime.fromtimestamp(hour * 3600, ZoneInfo(TIME_ZONE)).utcoffset()
+
+
+def fmt_ts(ts):
+    """Format UTC epoch microseconds as a TIME_FMT string in TIME_ZONE."""
+    local_time = EPOCH.replace(tzinfo=None) + timedelta(microseconds=ts) + _utc_offset(ts // 3600000000)
+    return local_time.strftime(TIME_FMT)
+
+
+def fmt_rows(rows):
+    return [(fmt_ts(ts), device_name, value) for (ts, device_name, value) in rows]
+
+
+def _fmt_chunks(chunks, as_chunks, raw_ts=False):
+    if raw_ts:
+        return chunks if as_chunks else (row for chunk in chunks for row in chunk)
+    if as_chunks:
+        return (fmt_rows(chunk) for chunk in chunks)
+    return (row for chunk in chunks for row in fmt_rows(chunk))
@@ -0,0 +1,79 @@
+# usage: python3 migrate.py [-h] [-c CHUNK_SIZE] [-k] db_file
+#
+# Copies rows from the v1 device_data/device_errors tables (local-time text
+# write_time keys) into the v2 schema, one chunk per transaction. The device
+# loop and server can keep running throughout: DeviceDatabaseHandler renames the
+# v1 tables to *_v1 on startup, new readings go straight into the v2 tables, and
+# this tool fills in the history behind them. Re-running it is safe: readings
+# are keyed on (device, time), and an error already copied (same device, time
+# and trace) is skipped.
+import sys
+import os
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+from db.database import DeviceDatabaseHandler, to_ts
+import argparse
+import logging
+
+
+def _iter_chunks(db, table_name, columns, chunk_size):
+    last_rowid = 0
+    while True:
+        query = f"SELECT rowid, {columns} FROM {table_name} WHERE rowid > ? ORDER BY rowid LIMIT ?"
+        chunk = db.execute_sql(query=query, args=(last_rowid, chunk_size))
+        if not chunk:
+            return
+        last_rowid = chunk[-1][0]
+        yield [row[1:] for row in chunk]
+
+
+def _migrate_table(db, table_name, columns, insert_query, chunk_size):
+    copied = 0
+    for chunk in _iter_chunks(db, table_name, columns, chunk_size):
+        rows = [(db.device_id(device_name), to_ts(write_time), value)
+                for (write_time, device_name, value) in chunk]
+        db.execute_sql(query=insert_query, args=rows, many=True)
+        copied += len(rows)
+        logging.info(f'{table_name}: copied {copied} rows')
+    return copied
+
+
+def migrate(db_filename, chunk_size=10000, keep_legacy=False):
+    db = DeviceDatabaseHandler(db_filename)
+
+    tables = {'device_data_v1': ("write_time, device_name, value",
+                                 "INSERT OR IGNORE INTO device_data (device_id, ts, value) VALUES (?,?,?)"),
+              'device_errors_v1': ("write_time, device_name, error_trace",
+                                   """INSERT INTO device_errors (device_id, ts, error_trace)
+                                      SELECT ?1, ?2, ?3
+                                      WHERE NOT EXISTS (SELECT 1
+                                                        FROM device_errors
+                                                        WHERE ts = ?2
+                                                        AND device_id = ?1
+                                                        AND error_trace IS ?3)""")}
+
+    for table_name, (columns, insert_query) in tables.items():
+        if not db._table_columns(table_name):
+            logging.info(f'No {table_name} table, nothing to migrate')
+            continue
+
+        copied = _migrate_table(db, table_name, columns, insert_query, chunk_size)
+        print(f'{table_name}: migrated {copied} rows')
+
+        if not keep_legacy:
+            db.execute_sql(query=f"DROP TABLE {table_name};")
+
+    db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate a v1 device database to the v2 schema in place.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("db_file", help="Path to device_data.db")
+    parser.add_argument("-c", "--chunk-size", default=10000, help="Rows copied per transaction.")
+    parser.add_argument("-k", "--keep-legacy", action="store_true", help="Keep the *_v1 tables after copying.")
+
+    args = parser.parse_args()
+    config = vars(args)
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    migrate(config['db_file'], chunk_size=int(config['chunk_size']), keep_legacy=config['keep_legacy'])
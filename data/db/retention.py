@@ -0,0 +1,31 @@
+# usage: python3 retention.py [-h] [-k KEEP_DAYS] [-a ARCHIVE_DIR] [--vacuum] db_file
+#
+# Moves raw device_data rows older than KEEP_DAYS into the per-device, per-month
+# column archive and frees the space they used. The device loop does this once
+# a day on its own; this is for running it by hand, and for the one-off full
+# VACUUM that enables incremental vacuum on databases created before it existed.
+import sys
+import os
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+from db.database import DeviceDatabaseHandler
+import argparse
+import logging
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Archive old raw device data and reclaim its space.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("db_file", help="Path to device_data.db")
+    parser.add_argument("-k", "--keep-days", default=90, help="Days of raw data to keep in the database.")
+    parser.add_argument("-a", "--archive-dir", default=None, help="Archive directory, ignore to use <db name>.archive/ next to the database.")
+    parser.add_argument("--vacuum", action="store_true", help="First run a full VACUUM to enable incremental vacuum.")
+
+    args = parser.parse_args()
+    config = vars(args)
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    db = DeviceDatabaseHandler(config['db_file'], archive_dir=config['archive_dir'])
+    if config['vacuum']:
+        db.vacuum(full=True)
+    archived = db.apply_retention(float(config['keep_days']))
+    db.close()
+    print(f'Archived {archived} rows.')
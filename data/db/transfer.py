@@ -0,0 +1,123 @@
+# usage: python3 transfer.py export [-h] [-n HOURS] [-s SINCE] [-u UNTIL] [-d DEVICE] [-f {csv,ndjson}] db_file out_file
+#        python3 transfer.py import [-h] [-c CHUNK_SIZE] [-f {csv,ndjson}] db_file in_file
+#
+# Streams device history between a database and CSV or NDJSON files, gzipped
+# when the file name ends in .gz. Use "-" for stdout/stdin. Rows are
+# ts,device_name,value with ts in UTC epoch microseconds, so an export
+# re-imports exactly. Exports read the archive and live tables through a
+# read-only connection, so they are safe to run next to the device loop.
+import sys
+import os
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+from db.database import DeviceDatabaseHandler, TIME_ZONE
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import argparse
+import json
+import gzip
+import csv
+import io
+
+FIELDS = ('ts', 'device_name', 'value')
+
+
+def _format(path, fmt):
+    if fmt:
+        return fmt
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'ndjson' if name.endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+
+def _open(path, mode):
+    if path == '-':
+        stream = sys.stdout.buffer if mode == 'w' else sys.stdin.buffer
+    elif path.endswith('.gz'):
+        # Fast compression: the point is to shrink text cheaply while streaming
+        stream = gzip.open(path, mode + 'b', compresslevel=3)
+    else:
+        stream = open(path, mode + 'b')
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+
+def export_rows(db_filename, out_path, since=0, until=None, device_names=None, fmt=None):
+    db = DeviceDatabaseHandler(db_filename, read_only=True)
+    rows = db.iter_history(since, until=until, device_names=device_names, chunk_size=10000, raw_ts=True)
+    exported = 0
+    with _open(out_path, 'w') as out:
+        if _format(out_path, fmt) == 'csv':
+            writer = csv.writer(out, lineterminator='\n')
+            writer.writerow(FIELDS)
+            for row in rows:
+                writer.writerow(row)
+                exported += 1
+        else:
+            for ts, device_name, value in rows:
+                out.write(json.dumps({'ts': ts, 'device_name': device_name, 'value': value}) + '\n')
+                exported += 1
+    db.close()
+    return exported
+
+
+def _read_csv(stream):
+    reader = csv.reader(stream)
+    header = next(reader, None)
+    if header is not None and tuple(header) != FIELDS:
+        raise ValueError(f'Expected a {",".join(FIELDS)} header, got {",".join(header)}')
+    for ts, device_name, value in reader:
+        yield int(ts), device_name, float(value)
+
+
+def _read_ndjson(stream):
+    for line in stream:
+        if line.strip():
+            row = json.loads(line)
+            yield int(row['ts']), row['device_name'], float(row['value'])
+
+
+def import_rows(db_filename, in_path, chunk_size=100000, fmt=None):
+    db = DeviceDatabaseHandler(db_filename)
+    with _open(in_path, 'r') as stream:
+        rows = _read_csv(stream) if _format(in_path, fmt) == 'csv' else _read_ndjson(stream)
+        imported = db.import_rows(rows, chunk_size=chunk_size)
+    db.close()
+    return imported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export or import device history as CSV or NDJSON.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help="Stream history out of a database.",
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    export_parser.add_argument("db_file", help="Path to device_data.db")
+    export_parser.add_argument("out_file", help="Output file (.csv, .ndjson, optionally .gz) or - for stdout")
+    export_parser.add_argument("-n", "--hours", default=None, help="Export the last HOURS hours, ignore to export everything.")
+    export_parser.add_argument("-s", "--since", default=None, help="Start time (YYYY-MM-DD HH:MM:SS, local time). Overrides --hours.")
+    export_parser.add_argument("-u", "--until", default=None, help="End time (YYYY-MM-DD HH:MM:SS, local time), ignore for now.")
+    export_parser.add_argument("-d", "--device", action="append", default=None, help="Device to export, repeat for several. Ignore for all devices.")
+    export_parser.add_argument("-f", "--format", choices=('csv', 'ndjson'), default=None, help="File format, ignore to infer from out_file.")
+
+    import_parser = subparsers.add_parser('import', help="Bulk-load history into a database.",
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    import_parser.add_argument("db_file", help="Path to device_data.db (created if missing)")
+    import_parser.add_argument("in_file", help="Input file (.csv, .ndjson, optionally .gz) or - for stdin")
+    import_parser.add_argument("-c", "--chunk-size", default=100000, help="Rows loaded per transaction.")
+    import_parser.add_argument("-f", "--format", choices=('csv', 'ndjson'), default=None, help="File format, ignore to infer from in_file.")
+
+    args = parser.parse_args()
+    config = vars(args)
+
+    if config['command'] == 'export':
+        since = 0
+        if config['since'] is not None:
+            since = config['since']
+        elif config['hours'] is not None:
+            since = datetime.now(ZoneInfo(TIME_ZONE)) - timedelta(hours=float(config['hours']))
+        count = export_rows(config['db_file'], config['out_file'], since=since, until=config['until'],
+                            device_names=config['device'], fmt=config['format'])
+        print(f'Exported {count} rows.', file=sys.stderr)
+    else:
+        count = import_rows(config['db_file'], config['in_file'], chunk_size=int(config['chunk_size']),
+                            fmt=config['format'])
+        print(f'Imported {count} rows.', file=sys.stderr)
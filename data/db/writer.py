@@ -0,0 +1,156 @@
+from db.database import BatchedWrites, is_locked, now_ts, stamp_values
+import threading
+import logging
+import atexit
+import queue
+import time
+
+
+class AsyncDatabaseWriter(BatchedWrites):
+    """Takes writes for a DeviceDatabaseHandler and commits them from a background thread.
+
+    Offers the same write_value/write_values/write_error/batch interface as the
+    handler, so it can be passed anywhere a database is expected. Writes are
+    timestamped when they are made, queued, and never block the caller: if the
+    database is locked the writer thread retries, backing off, up to
+    max_retries times before dropping the batch, and if the bounded queue fills
+    up new writes are dropped (and counted) rather than waited on. Writes
+    SQLite rejects outright (e.g. constraint failures) are dropped too.
+    """
+    def __init__(self, database, max_queue=10000, max_batch=500, retry_delay=1, max_retry_delay=30,
+                 max_retries=10):
+        self.db = database
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_retries = max_retries
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+        self._init_batching()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {'queue_depth': self.queue_depth,
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'last_flush_latency': self.last_flush_latency,
+                'max_flush_latency': self.max_flush_latency}
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logging.error(f'Database write queue full, {self.dropped} writes dropped so far')
+
+    def write_values(self, values, ts=None):
+        ts = ts if ts is not None else now_ts()
+        if values:
+            self._put(('values', stamp_values(values, ts)))
+
+    def write_error(self, device_name, error_trace, ts=None):
+        self._put(('error', (device_name, error_trace, ts if ts is not None else now_ts())))
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been committed. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self, timeout=10):
+        if self._thread.is_alive():
+            self.flush(timeout=timeout)
+            self._stop.set()
+            self._thread.join(timeout=1)
+
+    def _drain(self):
+        # Block briefly for the first item, then take whatever else is waiting
+        try:
+            items = [self.queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        while len(items) < self.max_batch:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _commit(self, items):
+        rows = [row for kind, payload in items if kind == 'values' for row in payload]
+        errors = [payload for kind, payload in items if kind == 'error']
+
+        start = time.monotonic()
+        # One transaction for everything drained together, so a retry never writes anything twice
+        self.db.write_rows_and_errors(rows, errors)
+
+        self.last_flush_latency = time.monotonic() - start
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        self.flushes += 1
+        self.rows_written += len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            items = self._drain()
+            if not items:
+                continue
+
+            self._commit_with_retry(items)
+            for _ in items:
+                self.queue.task_done()
+
+    def _commit_with_retry(self, items):
+        delay = self.retry_delay
+        retries = 0
+        while True:
+            try:
+                self._commit(items)
+                return
+            except Exception as e:
+                error = e
+            if not is_locked(error) or retries >= self.max_retries:
+                break
+            # Locked or busy: keep the batch and try again; only this thread waits
+            retries += 1
+            self.failures += 1
+            logging.warning(f'Database writer failed to commit {len(items)} queued writes, '
+                            f'retrying in {delay}s ({retries}/{self.max_retries}): {error}')
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+        if is_locked(error):
+            self.failures += 1
+            self.dropped += len(items)
+            logging.error(f'Database writer dropped {len(items)} queued writes, still locked after '
+                          f'{retries} retries: {error}')
+            return
+
+        # Retrying won't help bad data, so don't let it wedge the queue. Commit
+        # the batch one write at a time so only the bad write is lost.
+        if len(items) > 1:
+            for item in items:
+                self._commit_with_retry([item])
+            return
+        self.failures += 1
+        self.dropped += 1
+        logging.error(f'Database writer dropped a queued write: {error}')
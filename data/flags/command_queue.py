@@ -0,0 +1,226 @@
+from contextlib import closing, contextmanager
+import sqlite3
+import select
+import socket
+import time
+import os
+
+# Command lifecycle, same names the request flags used
+REQUESTED = 'request'
+CLAIMED = 'fulfilling'
+FULFILLED = 'fulfilled'
+FAILED = 'failed'
+
+COLUMNS = 'command_id, idempotency_key, device, action, value, status, created_at, updated_at, error'
+
+
+class CommandQueue:
+	"""Durable queue of device commands (e.g. "dose 2 ml of pH down") in its own SQLite file.
+
+	The web server enqueues, the device loop claims and completes. Every step
+	is one transaction, so concurrent workers can't lose or duplicate a
+	command, and each status change is one row update plus one history row.
+	Commands carry an optional idempotency key: enqueueing the same key again
+	returns the existing command instead of adding another. Times are UTC
+	epoch microseconds. Connections are opened per call, so one queue object
+	is safe across threads and forks.
+	"""
+	def __init__(self, db_filename, timeout=10):
+		self.db_filename = db_filename
+		self.timeout = timeout
+		self._create_tables()
+
+	@contextmanager
+	def _transaction(self, write=True):
+		with closing(sqlite3.connect(self.db_filename, timeout=self.timeout, isolation_level=None)) as conn:
+			conn.execute("PRAGMA journal_mode=WAL;")
+			# IMMEDIATE takes the write lock up front, so check-then-write steps can't interleave
+			conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+			try:
+				yield conn
+			except BaseException:
+				conn.execute("ROLLBACK")
+				raise
+			conn.execute("COMMIT")
+
+	def _create_tables(self):
+		with self._transaction() as conn:
+			conn.execute("""
+				CREATE TABLE IF NOT EXISTS commands (
+						command_id integer PRIMARY KEY,
+						idempotency_key text UNIQUE,
+						device text NOT NULL,
+						action text NOT NULL,
+						value real,
+						status text NOT NULL,
+						created_at integer NOT NULL,
+						updated_at integer NOT NULL,
+						error text
+				);
+				""")
+			# The device loop's pending lookup seeks straight to status = 'request'
+			conn.execute("CREATE INDEX IF NOT EXISTS commands_status_idx ON commands(status, command_id);")
+			conn.execute("""
+				CREATE TABLE IF NOT EXISTS command_history (
+						history_id integer PRIMARY KEY,
+						command_id integer NOT NULL,
+						ts integer NOT NULL,
+						status text NOT NULL,
+						previous_status text,
+						detail text
+				);
+				""")
+			conn.execute("CREATE INDEX IF NOT EXISTS command_history_command_idx ON command_history(command_id);")
+
+	def _set_status(self, conn, command_ids, status, previous_status, detail=None):
+		now = _now()
+		conn.executemany("UPDATE commands SET status = ?, updated_at = ?, error = coalesce(?, error) WHERE command_id = ?;",
+		                 [(status, now, detail if status == FAILED else None, command_id) for command_id in command_ids])
+		conn.executemany("""INSERT INTO command_history (command_id, ts, status, previous_status, detail)
+		                    VALUES (?,?,?,?,?);""",
+		                 [(command_id, now, status, previous_status, detail) for command_id in command_ids])
+
+	def enqueue(self, device, action, value=None, idempotency_key=None):
+		"""Add a command and return its command_id, or the existing one's if idempotency_key was seen before."""
+		return self.enqueue_many([(device, action, value, idempotency_key)])[0]
+
+	def enqueue_many(self, commands):
+		"""Add [(device, action, value, idempotency_key), ...] in one transaction and return their command_ids.
+
+		Either all of them are queued or none are, so the device loop never
+		claims part of a submission.
+		"""
+		command_ids = []
+		with self._transaction() as conn:
+			now = _now()
+			for device, action, value, idempotency_key in commands:
+				if idempotency_key is not None:
+					existing = conn.execute("SELECT command_id FROM commands WHERE idempotency_key = ?;",
+					                        (idempotency_key,)).fetchone()
+					if existing is not None:
+						command_ids.append(existing[0])
+						continue
+				cursor = conn.execute("""INSERT INTO commands (idempotency_key, device, action, value, status, created_at, updated_at)
+				                         VALUES (?,?,?,?,?,?,?);""",
+				                      (idempotency_key, device, action, value, REQUESTED, now, now))
+				command_id = cursor.lastrowid
+				self._set_status(conn, [command_id], REQUESTED, None)
+				command_ids.append(command_id)
+		return command_ids
+
+	def claim(self, limit=-1):
+		"""Mark up to limit requested commands as being fulfilled and return them (as dicts), oldest first."""
+		with self._transaction() as conn:
+			rows = conn.execute(f"SELECT {COLUMNS} FROM commands WHERE status = ? ORDER BY command_id LIMIT ?;",
+			                    (REQUESTED, limit)).fetchall()
+			self._set_status(conn, [row[0] for row in rows], CLAIMED, REQUESTED)
+		return [_command(row, status=CLAIMED) for row in rows]
+
+	def complete(self, command_id, error=None):
+		"""Mark a claimed command fulfilled, or failed with an error message."""
+		status = FAILED if error is not None else FULFILLED
+		with self._transaction() as conn:
+			self._set_status(conn, [command_id], status, CLAIMED, detail=error)
+
+	def fail_interrupted(self):
+		"""Fail commands claimed by a device loop that died mid-way; re-running a half-done dose isn't safe."""
+		with self._transaction() as conn:
+			command_ids = [row[0] for row in conn.execute("SELECT command_id FROM commands WHERE status = ?;", (CLAIMED,))]
+			self._set_status(conn, command_ids, FAILED, CLAIMED, detail='Interrupted: the device loop restarted')
+		return len(command_ids)
+
+	def has_pending(self):
+		with self._transaction(write=False) as conn:
+			return conn.execute("SELECT 1 FROM commands WHERE status = ? LIMIT 1;", (REQUESTED,)).fetchone() is not None
+
+	def get(self, command_id):
+		with self._transaction(write=False) as conn:
+			row = conn.execute(f"SELECT {COLUMNS} FROM commands WHERE command_id = ?;", (command_id,)).fetchone()
+		return _command(row) if row is not None else None
+
+	def recent(self, limit=50):
+		with self._transaction(write=False) as conn:
+			rows = conn.execute(f"SELECT {COLUMNS} FROM commands ORDER BY command_id DESC LIMIT ?;", (limit,)).fetchall()
+		return [_command(row) for row in rows]
+
+	def history(self, command_id):
+		with self._transaction(write=False) as conn:
+			rows = conn.execute("""SELECT ts, status, previous_status, detail
+			                       FROM command_history
+			                       WHERE command_id = ?
+			                       ORDER BY history_id;""", (command_id,)).fetchall()
+		return [{'ts': ts, 'status': status, 'previous_status': previous, 'detail': detail}
+		        for (ts, status, previous, detail) in rows]
+
+	def newest_history_id(self):
+		with self._transaction(write=False) as conn:
+			return conn.execute("SELECT coalesce(max(history_id), 0) FROM command_history;").fetchone()[0]
+
+	def history_after(self, history_id, limit=-1):
+		"""Status changes after history_id, oldest first, joined with their command, for change feeds."""
+		with self._transaction(write=False) as conn:
+			rows = conn.execute("""SELECT command_history.history_id, command_history.ts, command_history.status,
+			                              command_history.previous_status, command_history.detail,
+			                              commands.command_id, commands.device, commands.action, commands.value
+			                       FROM command_history
+			                       JOIN commands
+			                       ON commands.command_id = command_history.command_id
+			                       WHERE command_history.history_id > ?
+			                       ORDER BY command_history.history_id
+			                       LIMIT ?;""", (history_id, limit)).fetchall()
+		return [{'history_id': row[0], 'ts': row[1], 'status': row[2], 'previous_status': row[3], 'detail': row[4],
+		         'command_id': row[5], 'device': row[6], 'action': row[7], 'value': row[8]} for row in rows]
+
+
+def notify_commands(socket_path):
+	"""Wake a CommandListener after enqueueing. Returns False if nobody is listening (it will poll instead)."""
+	with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+		try:
+			sock.sendto(b'1', socket_path)
+		except OSError:
+			return False
+	return True
+
+
+class CommandListener:
+	"""Unix datagram socket that notify_commands() wakes, so the queue is checked when commands arrive rather than polled."""
+	def __init__(self, socket_path):
+		self.socket_path = socket_path
+		# A socket left behind by a previous run would make bind() fail
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self.sock.bind(socket_path)
+		# The web server may run as another user
+		os.chmod(socket_path, 0o666)
+		self.sock.setblocking(False)
+
+	def wait(self, timeout):
+		"""Block until notified or timeout seconds pass. Returns True if notified."""
+		readable, _, _ = select.select([self.sock], [], [], max(timeout, 0))
+		if not readable:
+			return False
+		# Several notifications may have queued up; one check of the queue covers them all
+		while True:
+			try:
+				self.sock.recv(16)
+			except BlockingIOError:
+				return True
+
+	def close(self):
+		self.sock.close()
+		try:
+			os.remove(self.socket_path)
+		except FileNotFoundError:
+			pass
+
+
+def _command(row, status=None):
+	command = dict(zip(COLUMNS.split(', '), row))
+	if status is not None:
+		command['status'] = status
+	return command
+
+
+def _now():
+	return time.time_ns() // 1000
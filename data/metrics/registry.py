@@ -0,0 +1,185 @@
+from contextlib import contextmanager
+import threading
+import tempfile
+import atexit
+import json
+import time
+import os
+
+# Seconds, from a fast SQLite query up to a whole sensor cycle
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+PREFIX = 'deep_culture_'
+
+HELP = {'cycle_seconds': 'Duration of a full sensor cycle.',
+        'cycle_lateness_seconds': 'How late each fixed sensor cycle started after its boundary.',
+        'cycle_overruns_total': 'Fixed cycle boundaries skipped because a cycle ran past them.',
+        'sample_lateness_seconds': 'How late each scheduled sensor reading started after it was due.',
+        'sample_overruns_total': 'Scheduled sensor readings skipped because the loop ran past them.',
+        'sensor_step_seconds': 'Duration of one sensor state in the cycle, including retries.',
+        'sensor_read_seconds': 'Duration of one Atlas sensor read attempt.',
+        'sensor_read_retries_total': 'Atlas sensor read attempts that failed and were retried.',
+        'sensor_read_failures_total': 'Atlas sensor reads that failed every attempt.',
+        'sensor_timeouts_total': 'Concurrent sensor reads that timed out or were skipped while a timed-out read was stuck.',
+        'db_query_seconds': 'SQLite query latency in execute_sql, by statement type, and of whole write transactions (TRANSACTION).',
+        'db_query_retries_total': 'SQLite queries retried after an error.',
+        'command_poll_seconds': 'Time to check the command queue for new requests.',
+        'request_fulfillment_seconds': 'Time from a command being queued to it being fulfilled.',
+        'writer_queue_depth': 'Writes waiting in the database writer queue.',
+        'writer_dropped': 'Writes the database writer has dropped since the device loop started.',
+        'sensor_value': 'Latest reading per device.',
+        'sensor_last_reading_timestamp_seconds': 'Time of the latest reading per device.',
+        'device_metrics_saved_timestamp_seconds': 'When the device loop last saved its metrics.',
+        'response_cache_hits_total': 'Dashboard page cache hits.',
+        'response_cache_misses_total': 'Dashboard page cache misses.'}
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms for one process, shared through a JSON file.
+
+    The device loop and each server worker keep their own registry and save it
+    (atomically, at most every save_interval seconds as metrics change, and at
+    exit) to path, which may contain "{pid}". The server's /metrics merges the
+    files with load() and merge() and renders them with render().
+    """
+    def __init__(self, path=None, save_interval=10):
+        self.path = path
+        self.save_interval = save_interval
+        self._metrics = dict()
+        self._lock = threading.Lock()
+        self._last_save = time.monotonic()
+        atexit.register(self.save)
+
+    def _series(self, kind, name, labels, **fields):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = {'type': kind, 'series': dict(), **fields}
+        key = tuple(sorted(labels.items()))
+        return metric, key
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            metric, key = self._series('counter', name, labels)
+            metric['series'][key] = metric['series'].get(key, 0) + amount
+        self._maybe_save()
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            metric, key = self._series('gauge', name, labels)
+            metric['series'][key] = value
+        self._maybe_save()
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            metric, key = self._series('histogram', name, labels, buckets=DEFAULT_BUCKETS)
+            series = metric['series'].get(key)
+            if series is None:
+                series = metric['series'][key] = {'counts': [0] * (len(metric['buckets']) + 1), 'sum': 0.0}
+            index = next((i for i, bound in enumerate(metric['buckets']) if value <= bound), len(metric['buckets']))
+            series['counts'][index] += 1
+            series['sum'] += value
+        self._maybe_save()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            metrics = dict()
+            for name, metric in self._metrics.items():
+                metrics[name] = {**metric, 'series': [{'labels': dict(key), 'value': value}
+                                                      for key, value in metric['series'].items()]}
+        return {'saved_at': time.time(), 'metrics': json.loads(json.dumps(metrics))}
+
+    def save(self):
+        if self.path is None:
+            return
+        path = self.path.format(pid=os.getpid())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+        self._last_save = time.monotonic()
+
+    def _maybe_save(self):
+        if self.path is not None and time.monotonic() - self._last_save > self.save_interval:
+            try:
+                self.save()
+            except OSError:
+                # Metrics must never take the device loop down; try again next interval
+                self._last_save = time.monotonic()
+
+
+def load(paths):
+    """Read saved snapshots, skipping files that are missing or mid-replace."""
+    snapshots = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def merge(snapshots):
+    """Combine snapshots: counters and histograms add up, gauges keep the last value seen."""
+    merged = dict()
+    for snapshot in snapshots:
+        for name, metric in snapshot['metrics'].items():
+            target = merged.setdefault(name, {**metric, 'series': dict()})
+            for series in metric['series']:
+                key = tuple(sorted(series['labels'].items()))
+                value = series['value']
+                current = target['series'].get(key)
+                if current is None or metric['type'] == 'gauge':
+                    target['series'][key] = value
+                elif metric['type'] == 'counter':
+                    target['series'][key] = current + value
+                else:
+                    target['series'][key] = {'counts': [a + b for a, b in zip(current['counts'], value['counts'])],
+                                             'sum': current['sum'] + value['sum']}
+    return merged
+
+
+def render(metrics):
+    """Prometheus text exposition for merge() output."""
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        full_name = PREFIX + name
+        if name in HELP:
+            lines.append(f'# HELP {full_name} {HELP[name]}')
+        lines.append(f'# TYPE {full_name} {metric["type"]}')
+        for key, value in sorted(metric['series'].items()):
+            labels = dict(key)
+            if metric['type'] != 'histogram':
+                lines.append(f'{full_name}{_labels(labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + ['+Inf'], value['counts']):
+                cumulative += count
+                lines.append(f'{full_name}_bucket{_labels({**labels, "le": bound})} {cumulative}')
+            lines.append(f'{full_name}_sum{_labels(labels)} {_number(value["sum"])}')
+            lines.append(f'{full_name}_count{_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Each process's registry; set METRICS.path to share it
+METRICS = MetricsRegistry()
@@ -1,38 +1,166 @@
 import utils
+import downsample
+import compression
 import parameters as parms
-from flask import Flask, render_template, jsonify, request, url_for
-from datetime import datetime, timedelta
+from cache import SharedResponseCache
+from events import EventBroadcaster
+from flask import Flask, Response, render_template, jsonify, request, url_for
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
+from itertools import chain
 import requests
 import logging
+import sqlite3
+import hashlib
+import glob
+import time
 import sys
 import os
 sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')))
-from db.database import DeviceDatabaseHandler, TIME_FMT
-from flags.flag_utils import read_flag, set_flag
+from db.database import DeviceDatabaseHandler, ROLLUPS, ROLLUP_COLUMNS
+from flags.command_queue import CommandQueue, notify_commands
+from metrics import registry
+from metrics.registry import METRICS
 
 app = Flask(__name__)
 
-DB = DeviceDatabaseHandler(parms.DB_NAME)
+# Each worker saves its own metrics file (they fork from here with --preload); stale ones go at startup
+os.makedirs(parms.METRICS_DIR, exist_ok=True)
+for stale in glob.glob(os.path.join(parms.METRICS_DIR, '*.json')):
+    os.remove(stale)
+METRICS.path = os.path.join(parms.METRICS_DIR, 'server-{pid}.json')
+
+# Read-only: the dashboard never runs DDL or takes write locks away from the device loop
+DB = DeviceDatabaseHandler(parms.DB_NAME, read_only=True)
+# Created at import so gunicorn --preload shares its counters across workers
+CACHE = SharedResponseCache(parms.CACHE_DIR, max_age=parms.CACHE_MAX_AGE)
+# The device loop owns the device database; requests go through their own queue database
+COMMANDS = CommandQueue(parms.COMMANDS_DB_NAME)
+EVENTS = EventBroadcaster(DB, COMMANDS, poll_seconds=parms.EVENT_POLL_SECONDS)
+# Part of the page's ETag, so a restart with new templates never answers 304 to an old page
+STARTED = int(time.time())
 logging.basicConfig(format='%(asctime)s %(message)s', filename=parms.LOG_FILENAME, level=logging.INFO)
 
 
-def _read_all_sensor_data(hours=48):
-    all_raw = DB.read_all_since(since=datetime.now(ZoneInfo(parms.TIME_ZONE)) - timedelta(hours=hours))
-    data_dict = utils.unpack_all(all_values=all_raw,
-                                 from_fmt=TIME_FMT,
-                                 to_fmt="ISO",
-                                 from_tz=parms.TIME_ZONE,
-                                 as_json=True)
-    return data_dict
+def _read_all_sensor_data(hours=parms.CHART_HOURS):
+    since = datetime.now(ZoneInfo(parms.TIME_ZONE)) - timedelta(hours=hours)
+    # Only the charted devices: the controls and raw pressure would be inlined in the page for nothing
+    all_raw = chain.from_iterable(DB.iter_device_since(device, since=since, raw_ts=True)
+                                  for device in parms.CHART_DEVICES)
+    # A chart can't show more points than it has pixels across
+    sampled = downsample.downsample_rows(all_raw, parms.CHART_POINTS, parms.CHART_DOWNSAMPLE)
+    return utils.pack_columns(sampled, devices=parms.CHART_DEVICES)
 
 
 @app.route("/")
 def index():
+    token = DB.change_token()
+    encoding = request.accept_encodings.best_match(compression.ENCODINGS)
+    # Each encoding is its own representation, so it gets its own strong ETag
+    etag = f'{token}-{STARTED}' + (f'-{encoding}' if encoding else '')
+    last_modified = datetime.fromtimestamp(DB.newest_ts() / 1000000, timezone.utc)
+
+    # Answered before touching the cache or the template: an unchanged refresh costs two queries
+    if request.if_none_match.contains(etag) or (not request.if_none_match and request.if_modified_since
+                                                and last_modified.replace(microsecond=0) <= request.if_modified_since):
+        response = Response(status=304)
+        cache_status = 'NOT-MODIFIED'
+    else:
+        key = f'index.{encoding}' if encoding else 'index'
+        body = CACHE.get(key, token)
+        cache_status = 'HIT'
+        if body is None:
+            # The uncompressed page may still be cached; this request's miss is already counted
+            html = CACHE.get('index', token, count=False) if encoding else None
+            if html is None:
+                html = _render_index().encode()
+                if encoding:
+                    CACHE.set('index', token, html)
+            body = compression.compress(html, encoding, cached=True)
+            CACHE.set(key, token, body)
+            cache_status = 'MISS'
+        response = Response(body, mimetype='text/html')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Cacheable, but always revalidated so new readings show up on refresh
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Cache'] = cache_status
+    return response
+
+
+@app.errorhandler(sqlite3.OperationalError)
+def database_unavailable(e):
+    # Until the device loop has created (or migrated) the schema there's nothing to read yet
+    if DB.schema_ready():
+        raise e
+    logging.warning(f'Database schema not ready: {e}')
+    response = jsonify({'success': False, 'message': 'The device database is not ready yet.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '30'
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """ETag, 304 and compression for the JSON endpoints (the index page handles its own)."""
+    if request.method != 'GET' or response.get_etag()[0] or not compression.compressible(response):
+        return response
+
+    encoding = request.accept_encodings.best_match(compression.ENCODINGS)
+    response.headers['Vary'] = 'Accept-Encoding'
+    body = response.get_data()
+    # Hashing the uncompressed body still saves the bandwidth on repeats
+    response.set_etag(hashlib.sha1(body).hexdigest() + (f'-{encoding}' if encoding else ''))
+    response.make_conditional(request)
+    if response.status_code == 200 and encoding:
+        response.set_data(compression.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition of the device loop's and every server worker's metrics."""
+    METRICS.save()
+    snapshots = registry.load([parms.DEVICE_METRICS_PATH] + glob.glob(os.path.join(parms.METRICS_DIR, '*.json')))
+    merged = registry.merge(snapshots)
+
+    latest = {'type': 'gauge', 'series': dict()}
+    latest_ts = {'type': 'gauge', 'series': dict()}
+    for (ts, device_name, value) in DB.read_all_latest(raw_ts=True):
+        latest['series'][(('device', device_name),)] = value
+        latest_ts['series'][(('device', device_name),)] = ts / 1000000
+    merged['sensor_value'] = latest
+    merged['sensor_last_reading_timestamp_seconds'] = latest_ts
+
+    device = registry.load([parms.DEVICE_METRICS_PATH])
+    if device:
+        # Stops moving if the device loop dies, which is worth alerting on
+        merged['device_metrics_saved_timestamp_seconds'] = {'type': 'gauge', 'series': {(): device[0]['saved_at']}}
+
+    stats = CACHE.stats()
+    merged['response_cache_hits_total'] = {'type': 'counter', 'series': {(): stats['hits']}}
+    merged['response_cache_misses_total'] = {'type': 'counter', 'series': {(): stats['misses']}}
+
+    return Response(registry.render(merged), mimetype='text/plain', headers={'Cache-Control': 'no-cache'})
+
+
+@app.route("/cache_stats")
+def cache_stats():
+    return jsonify(CACHE.stats())
+
+
+def _render_index():
     logging.info('Get data from DB...')
     latest_values_packed = DB.read_all_latest()
     latest_values = utils.unpack_latest(latest_values_packed)
 
+    # Taken before the read so no reading can fall between the page and the first update
+    cursor = DB.newest_ts()
     plot_values = _read_all_sensor_data()
 
     logging.info('Rendering HTML template...')
@@ -41,107 +169,187 @@ def index():
                                            temp=latest_values.get('water_temp_f', {'value': -1}).get('value', -1),
                                            ph=latest_values.get('ph', {'value': -1}).get('value', -1),
                                            ppm=int(latest_values.get('ec', {'value': -1}).get('value', -1)),
-                                           ph_data=plot_values['ph'],
-                                           ec_data=plot_values['ec'],
-                                           temp_data=plot_values['water_temp_f'],
-                                           level_data=plot_values['water_gallons'],
+                                           chart_data=utils.columns_to_json(plot_values),
+                                           chart_cursor=cursor,
+                                           chart_hours=parms.CHART_HOURS,
+                                           chart_poll_seconds=parms.CHART_POLL_SECONDS,
                                            timezone='"' + parms.TIME_ZONE + '"',
-                                           post_endpoint=url_for("device_request"))
+                                           post_endpoint=url_for("device_request"),
+                                           updates_endpoint=url_for("chart_updates"),
+                                           events_endpoint=url_for("events"))
 
 
-@app.route("/api_data", methods=['POST', 'GET'])
-def api():
-    logging.info('Responding to API data request...')
+@app.route("/chart_updates")
+def chart_updates():
+    """
+    Readings for the charted devices newer than the "cursor" query parameter (UTC epoch
+    microseconds, as handed out with the page and every update), in the dashboard's column
+    format: {"cursor": next cursor, "reset": false, "devices": {device: {"t0", "dt", "y"}}}.
 
-    request_data = request.get_json() or dict()
+    "reset" is true when more than CHART_UPDATE_MAX_ROWS readings are waiting, in which case
+    no rows are sent and the client should reload the page instead.
+    """
+    try:
+        cursor = int(request.args['cursor'])
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'message': 'cursor must be an integer timestamp'}), 400
 
-    days = request_data.get('days', 0)
-    hours = request_data.get('hours', 0)
-    minutes = request_data.get('minutes', 0)
-    seconds = request_data.get('seconds', 0)
+    rows = DB.read_all_after(cursor, device_names=parms.CHART_DEVICES, limit=parms.CHART_UPDATE_MAX_ROWS + 1,
+                             raw_ts=True)
+    if len(rows) > parms.CHART_UPDATE_MAX_ROWS:
+        return jsonify({'cursor': cursor, 'reset': True, 'devices': dict()})
 
-    if days + hours + minutes + seconds == 0:
-        days = 1
+    if rows:
+        cursor = rows[-1][0]
+    return jsonify({'cursor': cursor, 'reset': False, 'devices': utils.pack_columns(rows)})
 
-    since = datetime.now() - timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
 
-    logging.info(f'Reading data for {days} days, {hours} hours, {minutes} minutes, {seconds} seconds for modalities {modalities}...')
-    data = DB.read_since(since=since.timestamp(), modalities=modalities)
+@app.route("/events")
+def events():
+    """
+    Server-sent event stream of:
+        - "readings": {"cursor", "devices": {device: {"t0", "dt", "y"}}}, new rows in the
+          /chart_updates format. The event id is the cursor, so a reconnecting EventSource
+          (or the "cursor" query parameter) resumes where it left off.
+        - "error": {"error_id", "ts" (epoch ms), "device", "trace"}, new device errors
+        - "request": {"command_id", "device", "action", "status", "previous", "value", "detail"},
+          command status changes, e.g. "fulfilling" -> "fulfilled" once the device loop has acted
+        - "reset": {"cursor"}, too much was missed to stream; reload and resume from cursor
+    """
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    try:
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'cursor must be an integer timestamp'}), 400
 
-    logging.info('Returning data...')
-    return jsonify(data)
+    return Response(EVENTS.stream(cursor), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route("/api_data", methods=['POST', 'GET'])
+def api():
+    """
+    Query device history. Parameters come from the JSON body or the query string:
+        - "start"/"end": epoch seconds or ISO 8601 times (naive times are in TIME_ZONE).
+          Without "start", the window is the last "days"/"hours"/"minutes"/"seconds"
+          before "end" (now by default), or 1 day if none of those are given.
+        - "devices": list (or comma-separated string) of device names, all devices if omitted
+        - "agg": "raw", "min", "max", "mean" (default) or "last", the value reported per bucket
+        - "bucket": "raw", "minute", "hour" or "day" to fix the resolution; otherwise the
+          finest one that fits "max_points" (default API_DEFAULT_POINTS) is picked per device
+        - "downsample": "lttb" or "minmax" to read at up to API_MAX_POINTS instead and
+          downsample to "max_points" (e.g. the chart's width in pixels)
+
+    Each device's series is returned as {"resolution", "truncated", "t0", "dt", "y"}: epoch-ms
+    first time, ms gaps between times and values, like the dashboard's chart data. Fixed
+    resolutions return at most "max_points" points from the start of the window and set
+    "truncated" when there were more. The window is echoed back as "start"/"end" epoch seconds.
+    """
+    params = request.get_json(silent=True)
+    if params is None:
+        params = request.args.to_dict()
+        if 'devices' in request.args:
+            params['devices'] = ','.join(request.args.getlist('devices'))
+
+    try:
+        start, end = _api_window(params)
+        agg = params.get('agg', 'mean')
+        bucket = params.get('bucket')
+        method = params.get('downsample')
+        max_points = min(int(params.get('max_points', parms.API_DEFAULT_POINTS)), parms.API_MAX_POINTS)
+        devices = params.get('devices') or DB.device_names()
+        if isinstance(devices, str):
+            devices = [device for device in devices.split(',') if device]
+
+        if agg not in ('raw',) + tuple(ROLLUP_COLUMNS):
+            raise ValueError(f'Unknown agg {agg!r}')
+        if agg == 'raw':
+            if bucket not in (None, 'raw'):
+                raise ValueError('agg "raw" cannot be combined with a bucket')
+            bucket = 'raw'
+        if bucket not in (None, 'raw') + tuple(ROLLUPS):
+            raise ValueError(f'Unknown bucket {bucket!r}')
+        if method is not None and method not in downsample.METHODS:
+            raise ValueError(f'Unknown downsample {method!r}')
+        if max_points < 1:
+            raise ValueError('max_points must be positive')
+        unknown = [device for device in devices if DB.device_id(device, create=False) is None]
+        if unknown:
+            raise ValueError(f'Unknown devices: {", ".join(unknown)}')
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    logging.info(f'Responding to API data request for {devices} from {start} to {end} (agg {agg}, bucket {bucket})...')
+    series = dict()
+    read_points = parms.API_MAX_POINTS if method else max_points
+    for device in devices:
+        resolution = bucket or DB.pick_resolution(device, start, end, read_points)
+        # Every read is capped by a LIMIT, picked resolutions included (raw is picked from rollup
+        # counts, which can be stale); ask for one extra row to tell if it cut anything
+        rows = DB.read_device_series(device, start, end, max_points=read_points + 1,
+                                     agg=agg if agg != 'raw' else 'mean', resolution=resolution, raw_ts=True)
+        truncated = len(rows) > read_points
+        rows = rows[:read_points]
+        if method:
+            rows = downsample.downsample_rows(rows, max_points, method)
+        series[device] = utils.pack_columns(rows, devices=[device])[device]
+        series[device].update({'resolution': resolution, 'truncated': truncated})
+
+    return jsonify({'success': True, 'start': start, 'end': end, 'agg': agg, 'devices': series})
+
+
+def _api_window(params):
+    end = _api_time(params['end']) if params.get('end') is not None else datetime.now(timezone.utc).timestamp()
+    if params.get('start') is not None:
+        start = _api_time(params['start'])
+    else:
+        window = timedelta(days=float(params.get('days', 0)),
+                           hours=float(params.get('hours', 0)),
+                           minutes=float(params.get('minutes', 0)),
+                           seconds=float(params.get('seconds', 0)))
+        start = end - (window.total_seconds() or timedelta(days=1).total_seconds())
+    if start > end:
+        raise ValueError('start is after end')
+    return start, end
+
+
+def _api_time(value):
+    # Epoch seconds, or an ISO 8601 time; fromisoformat only takes "Z" from Python 3.11
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    when = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=ZoneInfo(parms.TIME_ZONE))
+    return when.timestamp()
 
 
 @app.route("/make_request", methods=['POST', 'GET'])
 def device_request():
     """
-    Request JSON array format:
-    {[device_name: {"status": status, "action": action, "value": value}, ...]}
-
-    Flag format:
-    {device_name: {action: {'status': status, 'value': value}, ...}, ...}
+    Queue device commands for the device loop.
 
-    Overall Format: 
-    flag[device][action]['status'] = status
-    flag[device][action]['value'] = val
+    Request JSON array format:
+    [{device_name: {"status": "request", "action": action, "value": value}}, ...]
 
     Example:
-    {
-       "ec":{
-          "nute1":{
-             "status":"fulfilled",
-             "value":1
-          },
-          "nute2":{
-             "status":"fulfilled",
-             "value":12
-          },
-          "nute3":{
-             "status":"fulfilled",
-             "value":1
-          },
-          "nute4":{
-             "status":"fulfilled",
-             "value":1
-          }
-       },
-       "ph":{
-          "up":{
-             "status":"fulfilled",
-             "value":1
-          },
-          "down":{
-             "status":"fulfilled",
-             "value":1
-          }
-       },
-       "level":{
-          "set":{
-             "status":"fulfilled",
-             "value":1
-          },
-          "fill":{
-             "status":"fulfilled",
-             "value":1
-          },
-          "drain":{
-             "status":"fulfilled",
-             "value":1
-          }
-       }
-    }
+    [
+       {"ph": {"status": "request", "action": "down", "value": 2}},
+       {"ec": {"status": "request", "action": "nute1", "value": 5}}
+    ]
+
+    Each entry becomes one command in the queue (see /commands), which moves through:
+        - "request": queued by the web server
+        - "fulfilling": claimed by the device loop, which is taking the action
+        - "fulfilled": the action finished
+        - "failed": the action raised, wasn't supported, or was interrupted by a restart
 
     Valid device names:
         - "ph"
         - "ec"
         - "level"
 
-    Valid status values:
-        - "request": Web server sets this value when requesting an action
-        - "fulfilling": Device server sets this value when taking the action
-        - "fulfilled": Device server sets this value when finished the action
-        - "failed": Device server sets this value when the action fails
-
     Valid action names:
         - "ph" device
             + "up" to dispense "value" ml of ph up 
@@ -156,32 +364,51 @@ def device_request():
             + "fill" to add "value" gallons
             + "drain" to drain out "value" gallons
 
-    This is an array to support multiple actions per device.
+    This is an array to support multiple actions per device. Send an Idempotency-Key
+    header to make retries safe: resending the same key returns the commands queued
+    the first time instead of queueing them again.
     """
-    request_data = request.get_json() or dict()
+    request_data = request.get_json() or list()
+    idempotency_key = request.headers.get('Idempotency-Key')
 
     try:
-        flag, _ = read_flag(parms.FLAG_PATH)
-    except FileNotFoundError:
-        flag = dict()
-
-    for req in request_data:
-        for device, device_req in req.items():
-            if device not in flag:
-                flag[device] = dict()
-            flag[device].update({device_req['action']: {'status': device_req['status'], 
-                                                        'value': device_req['value']}})
-
-    try:
-        set_flag(parms.FLAG_PATH, flag)
+        new_commands = []
+        for i, req in enumerate(request_data):
+            for device, device_req in req.items():
+                # Only new requests are queued; statuses are the device loop's to set
+                if device_req.get('status', 'request') != 'request':
+                    continue
+                key = f'{idempotency_key}:{i}:{device}' if idempotency_key else None
+                new_commands.append((device, device_req['action'], device_req.get('value'), key))
+        # All or nothing, so a failed request never leaves part of itself queued
+        command_ids = COMMANDS.enqueue_many(new_commands)
+        # Wakes the device loop right away; if it isn't listening it picks the commands up on its next poll
+        notify_commands(parms.COMMAND_SOCKET_PATH)
         success = True
-        message = 'Request flag set successfully.'
+        message = f'Queued {len(command_ids)} requests.'
 
     except Exception as e:
+        command_ids = []
         success = False
-        message = e
+        message = str(e)
+
+    return jsonify({'success': success, 'message': message, 'command_ids': command_ids})
+
+
+@app.route("/commands")
+def commands():
+    """The most recent commands (newest first), with their status and any error."""
+    limit = min(request.args.get('limit', 50, type=int), 1000)
+    return jsonify(COMMANDS.recent(limit))
+
 
-    return jsonify({'success': success, 'message': message})
+@app.route("/commands/<int:command_id>")
+def command(command_id):
+    """One command and every status change it has been through."""
+    found = COMMANDS.get(command_id)
+    if found is None:
+        return jsonify({'success': False, 'message': f'No command {command_id}'}), 404
+    return jsonify({**found, 'history': COMMANDS.history(command_id)})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+from multiprocessing import Value
+import tempfile
+import time
+import os
+
+
+class SharedResponseCache:
+	"""Rendered responses shared by every gunicorn worker, keyed on a data change token.
+
+	Entries are files in cache_dir (tmpfs by default), written atomically, so
+	whichever worker renders a page first serves it for all of them until the
+	token changes. Each worker also keeps the last entry per key in memory to
+	skip the file read on repeat hits. The hit/miss counters live in shared
+	memory, so they have to be created before gunicorn forks (--preload).
+	"""
+	def __init__(self, cache_dir, max_age=None):
+		self.cache_dir = cache_dir
+		self.max_age = max_age
+		os.makedirs(cache_dir, exist_ok=True)
+		# Entries rendered by a previous server start may come from older templates
+		for name in os.listdir(cache_dir):
+			os.remove(self._path(name))
+		self._local = dict()
+		self._hits = Value('L', 0)
+		self._misses = Value('L', 0)
+
+	def _path(self, key):
+		return os.path.join(self.cache_dir, key)
+
+	def _count(self, counter):
+		with counter.get_lock():
+			counter.value += 1
+
+	def _fresh(self, created):
+		return self.max_age is None or time.time() - created < self.max_age
+
+	def get(self, key, token, count=True):
+		"""The payload stored under key for token, or None.
+
+		Pass count=False for a fallback lookup made after a counted miss, so
+		one request never counts as more than one hit or miss.
+		"""
+		token = str(token)
+		entry = self._local.get(key)
+		if entry is None or entry[0] != token:
+			try:
+				with open(self._path(key), 'rb') as f:
+					entry_token, created = f.readline().decode().rstrip('\n').rsplit(' ', 1)
+					entry = (entry_token, float(created), f.read())
+			except (OSError, ValueError):
+				entry = None
+
+		if entry is not None and entry[0] == token and self._fresh(entry[1]):
+			self._local[key] = entry
+			if count:
+				self._count(self._hits)
+			return entry[2]
+
+		if count:
+			self._count(self._misses)
+		return None
+
+	def set(self, key, token, payload):
+		token = str(token)
+		created = time.time()
+		if isinstance(payload, str):
+			payload = payload.encode()
+		self._local[key] = (token, created, payload)
+
+		fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(f'{token} {created}\n'.encode() + payload)
+		os.replace(tmp_path, self._path(key))
+
+	def stats(self):
+		hits, misses = self._hits.value, self._misses.value
+		return {'hits': hits,
+				'misses': misses,
+				'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
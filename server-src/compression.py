@@ -0,0 +1,32 @@
+import gzip
+
+try:
+	import brotli
+except ImportError:
+	# Optional: without it everything is served gzipped
+	brotli = None
+
+# Preferred first; Accept-Encoding picks among these
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+# Worth compressing: anything smaller fits in a packet or two anyway
+MIN_SIZE = 1024
+COMPRESSIBLE_TYPES = ('text/html', 'application/json')
+
+
+def compress(payload, encoding, cached=False):
+	"""Compress bytes for a Content-Encoding. Cached payloads are compressed once, so harder."""
+	if encoding == 'br':
+		return brotli.compress(payload, quality=9 if cached else 4)
+	if encoding == 'gzip':
+		return gzip.compress(payload, compresslevel=9 if cached else 6)
+	return payload
+
+
+def compressible(response):
+	return (response.status_code == 200
+			and not response.is_streamed
+			and not response.direct_passthrough
+			and 'Content-Encoding' not in response.headers
+			and response.mimetype in COMPRESSIBLE_TYPES
+			and response.content_length is not None
+			and response.content_length >= MIN_SIZE)
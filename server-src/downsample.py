@@ -0,0 +1,85 @@
+from collections import defaultdict
+
+
+def lttb(points, threshold):
+	"""Largest-Triangle-Three-Buckets: pick threshold of the (x, y) points that keep the line's shape.
+
+	The first and last points are kept, the rest are split into threshold - 2
+	buckets, and each bucket keeps the point forming the largest triangle with
+	the previously kept point and the next bucket's average, which keeps spikes.
+	"""
+	n = len(points)
+	if threshold >= n or threshold < 3:
+		return list(points)
+
+	sampled = [points[0]]
+	every = (n - 2) / (threshold - 2)
+	a = 0
+	for i in range(threshold - 2):
+		avg_start = int((i + 1) * every) + 1
+		avg_end = min(int((i + 2) * every) + 1, n)
+		avg_x = avg_y = 0.0
+		for x, y in points[avg_start:avg_end]:
+			avg_x += x
+			avg_y += y
+		avg_x /= avg_end - avg_start
+		avg_y /= avg_end - avg_start
+
+		ax, ay = points[a]
+		max_area = -1.0
+		for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+			x, y = points[j]
+			# Twice the triangle's area; only the comparison matters
+			area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+			if area > max_area:
+				max_area = area
+				next_a = j
+		sampled.append(points[next_a])
+		a = next_a
+
+	sampled.append(points[-1])
+	return sampled
+
+
+def min_max(points, threshold):
+	"""Keep each bucket's lowest and highest point, in time order, for at most threshold of the (x, y) points.
+
+	Every extreme survives, so spikes (e.g. dosing events) are never smoothed
+	away, at the cost of a noisier line than lttb.
+	"""
+	n = len(points)
+	buckets = threshold // 2
+	if threshold >= n or buckets < 1:
+		return list(points)
+
+	sampled = []
+	every = n / buckets
+	for i in range(buckets):
+		start, end = int(i * every), int((i + 1) * every)
+		low = high = start
+		for j in range(start + 1, end):
+			if points[j][1] < points[low][1]:
+				low = j
+			elif points[j][1] > points[high][1]:
+				high = j
+		sampled.extend(points[j] for j in sorted({low, high}))
+	return sampled
+
+
+METHODS = {'lttb': lttb, 'minmax': min_max}
+
+
+def downsample_rows(rows, threshold, method='lttb'):
+	"""Downsample (ts, device_name, value) rows to at most threshold points per device.
+
+	Rows must be in time order per device; they come back grouped by device.
+	"""
+	downsample = METHODS[method]
+	points = defaultdict(list)
+	for (ts, device_name, value) in rows:
+		points[device_name].append((ts, value))
+
+	sampled = []
+	for device_name, device_points in points.items():
+		sampled.extend((ts, device_name, value) for (ts, value) in downsample(device_points, threshold))
+	return sampled
@@ -0,0 +1,153 @@
+import threading
+import logging
+import utils
+import queue
+import json
+import time
+import os
+
+
+class Subscriber:
+	def __init__(self, max_queue):
+		self.queue = queue.Queue(maxsize=max_queue)
+		# Set when the subscriber fell too far behind and missed events
+		self.overflowed = False
+
+
+class EventBroadcaster:
+	"""Server-sent events for new readings, device errors and request status changes.
+
+	One watcher thread per process polls for changes and fans each event out
+	to every connected client's queue, so SQLite sees the same few queries a
+	second however many clients are connected. PRAGMA data_version (which
+	changes whenever another connection commits) gates the reading and error
+	queries; request status changes come from the command queue's history,
+	read from a history_id cursor.
+	The thread starts with the first subscriber in a worker and exits once
+	the last one disconnects.
+	"""
+	def __init__(self, db, commands, poll_seconds=1, heartbeat_seconds=15, max_queue=1000, max_rows=5000):
+		self.db = db
+		self.commands = commands
+		self.poll_seconds = poll_seconds
+		self.heartbeat_seconds = heartbeat_seconds
+		self.max_queue = max_queue
+		self.max_rows = max_rows
+
+		self._lock = threading.Lock()
+		self._subscribers = set()
+		self._thread = None
+		self._pid = None
+
+	def subscribe(self):
+		subscriber = Subscriber(self.max_queue)
+		with self._lock:
+			self._subscribers.add(subscriber)
+			# A thread started before a fork doesn't exist in the child
+			if self._thread is None or self._pid != os.getpid():
+				self._pid = os.getpid()
+				self._thread = threading.Thread(target=self._run, name='event-watcher', daemon=True)
+				self._thread.start()
+		return subscriber
+
+	def unsubscribe(self, subscriber):
+		with self._lock:
+			self._subscribers.discard(subscriber)
+
+	def stream(self, cursor=None):
+		"""Yield SSE messages for one client, starting with readings newer than cursor if given."""
+		subscriber = self.subscribe()
+		try:
+			yield f'retry: {self.poll_seconds * 1000 * 5}\n\n'
+			if cursor is not None:
+				yield self._catch_up(cursor)
+
+			while not subscriber.overflowed:
+				try:
+					yield subscriber.queue.get(timeout=self.heartbeat_seconds)
+				except queue.Empty:
+					# Comment line, keeps proxies from closing an idle connection
+					yield ': keepalive\n\n'
+
+			yield _message('reset', {'cursor': self.db.newest_ts()})
+		finally:
+			self.unsubscribe(subscriber)
+
+	def _catch_up(self, cursor):
+		rows = self.db.read_all_after(cursor, limit=self.max_rows + 1, raw_ts=True)
+		if len(rows) > self.max_rows:
+			return _message('reset', {'cursor': self.db.newest_ts()})
+		return self._readings_message(rows, cursor)
+
+	def _readings_message(self, rows, cursor):
+		if rows:
+			cursor = rows[-1][0]
+		return _message('readings', {'cursor': cursor, 'devices': utils.pack_columns(rows)}, event_id=cursor)
+
+	def _publish(self, message):
+		with self._lock:
+			subscribers = list(self._subscribers)
+		for subscriber in subscribers:
+			try:
+				subscriber.queue.put_nowait(message)
+			except queue.Full:
+				subscriber.overflowed = True
+
+	def _run(self):
+		cursor = self.db.newest_ts()
+		error_id = self.db.newest_error_id()
+		data_version = None
+		history_id = self.commands.newest_history_id()
+
+		while True:
+			time.sleep(self.poll_seconds)
+			with self._lock:
+				if not self._subscribers:
+					self._thread = None
+					return
+
+			try:
+				version = self.db.execute_sql(query="PRAGMA data_version", catch_errors=False)[0][0]
+				if version != data_version:
+					data_version = version
+					cursor = self._check_readings(cursor)
+					error_id = self._check_errors(error_id)
+
+				history_id = self._check_commands(history_id)
+			except Exception as e:
+				logging.error(f'Event watcher check failed: {e}')
+
+	def _check_readings(self, cursor):
+		rows = self.db.read_all_after(cursor, limit=self.max_rows + 1, raw_ts=True)
+		if len(rows) > self.max_rows:
+			# e.g. a bulk import; clients reload rather than take it all as events
+			cursor = self.db.newest_ts()
+			self._publish(_message('reset', {'cursor': cursor}))
+		elif rows:
+			cursor = rows[-1][0]
+			self._publish(self._readings_message(rows, cursor))
+		return cursor
+
+	def _check_errors(self, error_id):
+		for (error_id, ts, device_name, error_trace) in self.db.read_errors_after(error_id, limit=self.max_rows):
+			self._publish(_message('error', {'error_id': error_id, 'ts': ts // 1000, 'device': device_name,
+			                                 'trace': error_trace}))
+		return error_id
+
+	def _check_commands(self, history_id):
+		for change in self.commands.history_after(history_id, limit=self.max_rows):
+			history_id = change['history_id']
+			self._publish(_message('request', {'command_id': change['command_id'], 'device': change['device'],
+			                                   'action': change['action'], 'status': change['status'],
+			                                   'previous': change['previous_status'], 'value': change['value'],
+			                                   'detail': change['detail']}))
+		return history_id
+
+
+def _message(event, data, event_id=None):
+	lines = [f'event: {event}']
+	if event_id is not None:
+		lines.append(f'id: {event_id}')
+	lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+	return '\n'.join(lines) + '\n\n'
+
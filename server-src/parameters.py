@@ -1,6 +1,27 @@
 DB_NAME = "/data/db/device_data.db"
-FLAG_PATH = "/data/flags/request_flags.json"
+COMMANDS_DB_NAME = "/data/db/commands.db"
+COMMAND_SOCKET_PATH = "/data/flags/commands.sock"
 LOG_FILENAME = "/data/logs/server_job.log"
+CACHE_DIR = "/dev/shm/deep-culture-cache"
+# New data lands every cycle (900 s), so cached pages never outlive one
+CACHE_MAX_AGE = 900
+# Server workers share metrics through files here; the device loop saves its own to DEVICE_METRICS_PATH
+METRICS_DIR = "/dev/shm/deep-culture-metrics"
+DEVICE_METRICS_PATH = "/metrics/device_metrics.json"
 
 TIME_ZONE = "America/New_York"
 PLOT_TIME_FMT = "%-H:%M"
+# Devices plotted on the dashboard, in chart order (see static/scripts/charts.js)
+CHART_DEVICES = ("ph", "ec", "water_temp_f", "water_gallons")
+CHART_HOURS = 48
+# Open dashboards poll /chart_updates this often, and reload if more rows than this are waiting
+CHART_POLL_SECONDS = 30
+CHART_UPDATE_MAX_ROWS = 5000
+# How often each server process checks for new events to push to /events clients
+EVENT_POLL_SECONDS = 1
+# /api_data point budget per device: default and hard cap
+API_DEFAULT_POINTS = 1000
+API_MAX_POINTS = 20000
+# Dashboard charts are downsampled to this many points per device ("lttb" or "minmax")
+CHART_POINTS = 800
+CHART_DOWNSAMPLE = "lttb"
@@ -1,5 +1,16 @@
+/* Decode a {t0, dt, y} column payload (epoch-ms base plus time deltas) into Chart.js points */
+const decodeColumns = (columns) => {
+  const points = new Array(columns.y.length);
+  let t = columns.t0;
+  for (let i = 0; i < points.length; i++) {
+    t += columns.dt[i];
+    points[i] = {x: t, y: columns.y[i]};
+  }
+  return points;
+};
+
 const createChart = (chart_element_id, dataset, border_color, title, y_min, y_max, tz) => {
-  new Chart(document.getElementById(chart_element_id), {
+  return new Chart(document.getElementById(chart_element_id), {
     type: 'line',
     data: {
       datasets: [{ 
@@ -10,6 +21,9 @@ const createChart = (chart_element_id, dataset, border_color, title, y_min, y_ma
       ]
     },
     options: {
+      /* Points arrive decoded, sorted and with numeric times, so skip Chart.js parsing */
+      parsing: false,
+      normalized: true,
       plugins: {
         legend: {
           display: false
@@ -78,12 +92,62 @@ const createChart = (chart_element_id, dataset, border_color, title, y_min, y_ma
 };
 
 const chartElements = ["ph-chart", "ec-chart", "temp-chart", "level-chart"]
-const data = [ph_data, ec_data, temp_data, level_data]
+const devices = ["ph", "ec", "water_temp_f", "water_gallons"]
+const data = devices.map((device) => decodeColumns(chartData[device]))
 const colors = ["#DE3163", "#9FE2BF", "#FF7F50", "#CCCCFF"]
 const titles = ["Nutrient Solution pH", "Nutrient Solution EC (PPM)", "Water Temperature (°F)", "Water Level (gallons)"]
 const ymins = [5.5, 250, 65, 5.5]
 const ymaxes = [6.5, 1000, 75, 8]
 
-var _ = chartElements.map(function(e, i) {
-  createChart(e, data[i], colors[i], titles[i], ymins[i], ymaxes[i], appTimezone);
+const charts = chartElements.map(function(e, i) {
+  return createChart(e, data[i], colors[i], titles[i], ymins[i], ymaxes[i], appTimezone);
 });
+
+/* Append readings newer than the cursor in place and drop points older than the chart window */
+let cursor = chartCursor;
+
+const appendUpdates = (update) => {
+  const oldest = Date.now() - chartHours * 3600 * 1000;
+  devices.forEach((device, i) => {
+    const points = charts[i].data.datasets[0].data;
+    const newest = points.length ? points[points.length - 1].x : -Infinity;
+    if (device in update.devices) {
+      /* The page's cursor is taken just before its data is read, so skip anything already plotted */
+      points.push(...decodeColumns(update.devices[device]).filter((point) => point.x > newest));
+    }
+    let trim = 0;
+    while (trim < points.length && points[trim].x < oldest) {
+      trim++;
+    }
+    points.splice(0, trim);
+    charts[i].update('none');
+  });
+};
+
+const pollUpdates = () => {
+  fetch(`${updatesEndpoint}?cursor=${cursor}`)
+    .then((response) => response.json())
+    .then((update) => {
+      if (update.reset) {
+        window.location.reload();
+        return;
+      }
+      cursor = update.cursor;
+      appendUpdates(update);
+    })
+    .catch((error) => console.error('Chart update failed:', error))
+    .finally(() => setTimeout(pollUpdates, chartPollSeconds * 1000));
+};
+
+if (window.EventSource) {
+  /* Pushed as they land; EventSource resumes from the last event id after a reconnect */
+  const source = new EventSource(`${eventsEndpoint}?cursor=${cursor}`);
+  source.addEventListener('readings', (event) => {
+    const update = JSON.parse(event.data);
+    cursor = update.cursor;
+    appendUpdates(update);
+  });
+  source.addEventListener('reset', () => window.location.reload());
+} else {
+  setTimeout(pollUpdates, chartPollSeconds * 1000);
+}
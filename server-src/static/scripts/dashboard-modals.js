@@ -280,6 +280,8 @@ class confirmModalBox {
 	
 	show(postData, confirmString) {
 		this.postData = postData;
+		// One key per confirmation, so a double click or a retried POST queues the commands once
+		this.idempotencyKey = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
 		this.bodyText.innerHTML = confirmString;
 		this.elem.classList.toggle('is-active');
 		this.onShow()
@@ -310,7 +312,8 @@ class confirmModalBox {
 		return fetch(this.postEndpoint, {
 			'method': method,
 			'headers': {
-				"Content-Type": "application/json"
+				"Content-Type": "application/json",
+				"Idempotency-Key": this.idempotencyKey
 			},
 			'body': JSON.stringify(this.postData)
 		})
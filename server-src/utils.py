@@ -1,7 +1,4 @@
-from collections import defaultdict
-from zoneinfo import ZoneInfo
-from datetime import datetime
-import time
+import json
 
 
 def unpack_latest(latest_values):
@@ -11,45 +8,33 @@ def unpack_latest(latest_values):
 	return data
 
 
-def unpack_all(all_values, from_fmt=None, to_fmt=None, from_tz=None, as_json=True):
-	data = defaultdict(lambda: defaultdict(list))
-	if from_fmt:
-		# Either two formats supplied or just from_fmt supplied
-		for (write_time, device_name, value) in all_values:
-			data[device_name]['time'].append(fmt_timestamp(write_time, from_fmt, to_fmt, from_tz))
-			data[device_name]['value'].append(value)	
-	else:
-		# No formats supplied, don't convert times
-		for (write_time, device_name, value) in all_values:
-			data[device_name]['time'].append(write_time)
-			data[device_name]['value'].append(value)
-	if as_json:
-		return repack_to_json(data)
+def pack_columns(rows, devices=None):
+	"""Pack (ts, device_name, value) rows, ts in UTC epoch microseconds, into chart columns per device.
+
+	Each device gets {"t0": first time, "dt": [gaps between times], "y": [values]},
+	times in epoch milliseconds, which charts.js decodes straight into datasets.
+	Rows must be in time order per device. When devices is given, rows for any
+	other device are dropped.
+	"""
+	data = {device: {'t0': None, 'dt': [], 'y': []} for device in devices or ()}
+	last = dict()
+	for (ts, device_name, value) in rows:
+		ms = ts // 1000
+		columns = data.get(device_name)
+		if columns is None:
+			if devices is not None:
+				continue
+			columns = data[device_name] = {'t0': None, 'dt': [], 'y': []}
+		if columns['t0'] is None:
+			columns['t0'] = ms
+			columns['dt'].append(0)
+		else:
+			columns['dt'].append(ms - last[device_name])
+		last[device_name] = ms
+		columns['y'].append(value)
 	return data
 
 
-def fmt_timestamp(timestamp, from_fmt, to_fmt, from_tz=None):
-	if to_fmt is None:
-		# Only from_fmt supplied (return UNIX ms since epoch timestamp)
-		return int(1000 * datetime.strptime(timestamp, from_fmt).timestamp())
-	if to_fmt.lower() == "iso":
-		from_tz = from_tz or "US/Eastern"
-		return to_utc_string(timestamp, from_fmt, from_tz)
-	return datetime.strptime(timestamp, from_fmt).strftime(to_fmt)
-
-
-def repack_to_json(data):
-	data_json = dict()
-	for device in data:
-		device_strs = []
-		for write_time, value in zip(data[device]['time'], data[device]['value']):
-			device_strs.append("{" + f'"x": "{write_time}", "y": {value}' + "}")
-		data_json[device] = "[" + ",".join(device_strs) + "]"
-	return data_json
-
-
-def to_utc_string(timestamp, from_fmt, from_tz):
-	write_time_obj = datetime.strptime(timestamp, from_fmt)
-	iso_fmt = "%Y-%m-%dT%H:%M:%SZ"
-	offset = write_time_obj.astimezone(ZoneInfo(from_tz)).utcoffset()
-	return (write_time_obj - offset).strftime(iso_fmt)
+def columns_to_json(data):
+	# No whitespace, and "</" escaped so the payload can be inlined in a <script> tag
+	return json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
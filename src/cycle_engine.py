@@ -0,0 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import logging
+import time
+import sys
+import os
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')))
+from metrics.registry import METRICS
+
+
+class SensorTask:
+    """One sensor state to run each cycle.
+
+    bus: reads on the same bus never overlap (None for a sensor nothing else shares)
+    after: names of tasks that must finish, or time out, before this one starts
+    timeout: seconds a read may take, once it has its bus, before the cycle moves on without it
+    """
+    def __init__(self, state, bus=None, after=(), timeout=30):
+        self.state = state
+        self.name = str(state)
+        self.bus = bus
+        self.after = tuple(after)
+        self.timeout = timeout
+
+
+class CycleEngine:
+    """Runs one cycle of sensor reads concurrently and returns {state name: result}.
+
+    Each task runs on its own pool thread as soon as the tasks it comes after
+    are done, holding its bus's lock for the whole read, so a cycle takes about
+    as long as its slowest chain of dependent or same-bus reads. A read that
+    overruns its timeout counts as a failed read (0, like the states return on
+    a sensor error, plus a logged device error). Python can't stop the thread,
+    so that sensor is skipped in later cycles until the stuck read returns.
+    """
+    def __init__(self, tasks, database):
+        self.tasks = {task.name: task for task in tasks}
+        self.db = database
+        self._check_dependencies()
+        self._bus_locks = {task.bus: threading.Lock() for task in tasks if task.bus is not None}
+        self._pool = ThreadPoolExecutor(max_workers=len(self.tasks), thread_name_prefix='sensor')
+        # Reads that timed out and are still running, by task name
+        self._stuck = dict()
+
+    def _check_dependencies(self):
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f'Sensor tasks depend on each other in a cycle: {name}')
+            visiting.add(name)
+            for dependency in self.tasks[name].after:
+                if dependency not in self.tasks:
+                    raise ValueError(f'{name} runs after unknown sensor task {dependency}')
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.tasks:
+            visit(name)
+
+    def _read(self, task, started):
+        lock = self._bus_locks.get(task.bus)
+        # A read stuck after timing out keeps its bus; don't queue up behind it forever
+        if lock is not None and not lock.acquire(timeout=task.timeout):
+            raise TimeoutError(f'The {task.bus} bus was busy for {task.timeout} seconds')
+        try:
+            # The timeout only counts once the read has the bus
+            started[task.name] = time.monotonic()
+            logging.info(f"Step: {task.name}")
+            with METRICS.timer('sensor_step_seconds', state=task.name):
+                return task.state.run()
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _fail(self, task, message):
+        logging.error(f"Sensor read error for {task.name}: {message}")
+        self.db.write_error(task.name, message)
+        METRICS.inc('sensor_timeouts_total', sensor=task.name)
+        return 0
+
+    def run(self, names=None):
+        # Just the named tasks if given; ones they'd run after but aren't named don't hold them up
+        tasks = {name: task for name, task in self.tasks.items() if names is None or name in names}
+        results = dict()
+        waiting = dict(tasks)
+        running = dict()
+        started = dict()
+
+        while waiting or running:
+            for name, task in list(waiting.items()):
+                if any(dependency in tasks and dependency not in results for dependency in task.after):
+                    continue
+                del waiting[name]
+                stuck = self._stuck.get(name)
+                if stuck is not None and not stuck.done():
+                    results[name] = self._fail(task, f'Skipped: the previous read has not returned after '
+                                                     f'{task.timeout} seconds')
+                    continue
+                self._stuck.pop(name, None)
+                running[self._pool.submit(self._read, task, started)] = task
+
+            if not running:
+                continue
+
+            now = time.monotonic()
+            deadlines = [started[task.name] + task.timeout for task in running.values() if task.name in started]
+            timeout = max(0, min(deadlines) - now) if deadlines else 0.05
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                task = running.pop(future)
+                try:
+                    results[task.name] = future.result()
+                except TimeoutError as e:
+                    results[task.name] = self._fail(task, str(e))
+
+            now = time.monotonic()
+            for future, task in list(running.items()):
+                if task.name in started and now - started[task.name] > task.timeout:
+                    del running[future]
+                    self._stuck[task.name] = future
+                    results[task.name] = self._fail(task, f'Timed out after {task.timeout} seconds')
+
+        # Same order as the tasks were given, like the sequential cycle
+        return {name: results[name] for name in tasks}
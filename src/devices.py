@@ -5,12 +5,15 @@ from atlas_i2c import sensors, commands
 from w1thermsensor import W1ThermSensor, Unit
 from gpiozero import DigitalOutputDevice, DeviceClosed
 from qwiic_relay import QwiicRelay
+from concurrent.futures import ThreadPoolExecutor
 import board
 import busio
 import statistics
 import time
 import sys
 import os
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')))
+from metrics.registry import METRICS
 
 
 class MOSFETSwitchDevice:
@@ -113,24 +116,55 @@ class AtlasSensor:
         self.sensor = self._setup(name, address)
         self.name = name
         self.max_attempts = max_attempts
+        self._ready_at = None
+        self._start_error = None
 
     def _setup(self, name, address):
         sensor = sensors.Sensor(name, address)
         sensor.connect()
         return sensor
 
-    def read(self, attempts=0):
-        if attempts < self.max_attempts:
-            # Retry with linear backoff
-            time.sleep(attempts + 1)
+    def start(self):
+        # Send READ without waiting; the board converts for READ's processing delay
+        try:
+            self.sensor.client.write(commands.READ.format_command())
+            self._ready_at = time.monotonic() + commands.READ.processing_delay / 1000
+            self._start_error = None
+        except Exception as e:
+            # collect() retries
+            self._ready_at = None
+            self._start_error = e
+
+    def _collect_once(self):
+        if self._ready_at is None:
+            raise self._start_error or SystemError(f'No reading was started for the {self.name} sensor.')
+        time.sleep(max(0, self._ready_at - time.monotonic()))
+        self._ready_at = None
+        response = self.sensor.client.read(commands.READ.format_command())
+        # 1 is success; 2 syntax error, 254 still converting, 255 no data
+        if response.status_code != 1:
+            raise SystemError(f'{self.name} sensor responded with status {response.status_code}')
+        return response.data.decode("ascii")
+
+    def collect(self):
+        # Wait for the reading start() began; on failure back off (linearly) and read again
+        for attempts in range(self.max_attempts):
+            if attempts:
+                METRICS.inc('sensor_read_retries_total', sensor=self.name)
+                time.sleep(attempts)
+                self.start()
             try:
-                response = self.sensor.query(commands.READ)
-                return response.data.decode("ascii")
+                with METRICS.timer('sensor_read_seconds', sensor=self.name):
+                    return self._collect_once()
+            except Exception:
+                continue
 
-            except Exception as e:
-                return self.read(attempts=attempts+1)
+        METRICS.inc('sensor_read_failures_total', sensor=self.name)
+        raise SystemError(f'There is a problem communicating with the {self.name} sensor. {self.max_attempts} attempts failed.')
 
-        raise SystemError(f'There is a problem communicating with the {self.name} sensor. {attempts} attempts failed.')
+    def read(self):
+        self.start()
+        return self.collect()
 
 
 class ETapeSensor:
@@ -214,8 +248,19 @@ class MPRLSSensor:
 class TempSensor:
     def __init__(self):
         self.sensor = W1ThermSensor()
+        # w1thermsensor blocks for the whole DS18B20 conversion, so start() runs it here
+        self._converter = ThreadPoolExecutor(max_workers=1, thread_name_prefix='w1')
+        self._pending = None
 
-    def read(self, decimals=1):
-        temp = self.sensor.get_temperature(Unit.DEGREES_F)
+    def start(self):
+        self._pending = self._converter.submit(self.sensor.get_temperature, Unit.DEGREES_F)
 
-        return round(temp, decimals)
+    def collect(self, decimals=1):
+        if self._pending is None:
+            self.start()
+        pending, self._pending = self._pending, None
+        return round(pending.result(), decimals)
+
+    def read(self, decimals=1):
+        self.start()
+        return self.collect(decimals)
@@ -0,0 +1,48 @@
+# usage: python3 db_benchmark.py [-h] [-n OPERATIONS] [-f DB_FILE]
+import sys
+import os
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')))
+from db.database import DeviceDatabaseHandler
+import argparse
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description="Measure device database writes/sec and reads/sec.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-n", "--operations", default=500, help="Number of writes (and reads) to time per mode.")
+parser.add_argument("-f", "--db-file", default=None, help="Scratch database file, ignore to use a temporary directory. Never point this at the live database.")
+
+args = parser.parse_args()
+config = vars(args)
+
+
+def time_ops(func, n):
+    start = time.perf_counter()
+    for i in range(n):
+        func(i)
+    return n / (time.perf_counter() - start)
+
+
+def run_mode(db_filename, persistent, n):
+    db = DeviceDatabaseHandler(db_filename, persistent=persistent)
+    writes = time_ops(lambda i: db.write_value("benchmark", float(i)), n)
+    reads = time_ops(lambda _: db.read_device_latest("benchmark"), n)
+    db.close()
+    return writes, reads
+
+
+n = int(config['operations'])
+with tempfile.TemporaryDirectory() as tmp_dir:
+    db_filename = config['db_file'] or os.path.join(tmp_dir, 'benchmark.db')
+
+    print(f"Timing {n} writes and {n} reads per mode against {db_filename}")
+    print('Mode'.ljust(12) + ' ' + 'Writes/sec'.rjust(12) + ' ' + 'Reads/sec'.rjust(12))
+    print("=====================================")
+    baseline = None
+    for mode, persistent in (('per-query', False), ('persistent', True)):
+        writes, reads = run_mode(db_filename, persistent, n)
+        print(mode.ljust(12) + ' ' + f"{writes:12.1f}" + ' ' + f"{reads:12.1f}")
+        if baseline is None:
+            baseline = (writes, reads)
+
+    print(f"\nSpeedup: {writes / baseline[0]:.2f}x writes, {reads / baseline[1]:.2f}x reads")
@@ -1,8 +1,8 @@
 # usage: python3 get_data.py [-h] [-n HOURS] [-d DEVICE]
 import sys
 import os
-sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
-from database import DeviceDatabaseHandler
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')))
+from db.database import DeviceDatabaseHandler
 import argparse
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
@@ -20,10 +20,11 @@ config = vars(args)
 
 start_time = datetime.now(ZoneInfo(TIME_ZONE)) - timedelta(hours=float(config['hours']))
 
+# Rows are printed as they come off the cursor, so long ranges never sit in memory
 if config['device'] is None:
-    data = DB.read_all_since(since=start_time)
+    data = DB.iter_all_since(since=start_time)
 else:
-    data = DB.read_device_since(device_name=config['device'], since=start_time)
+    data = DB.iter_device_since(device_name=config['device'], since=start_time)
 
 print('Time'.ljust(27) + ' ' + 'Device'.ljust(20) + ' ' + 'Value')
 print("===================================================================")
@@ -0,0 +1,44 @@
+# usage: python3 unpack_benchmark.py [-h] [-n ROWS [ROWS ...]] [-i INTERVAL] [-p POINTS] [-m {lttb,minmax}]
+import sys
+import os
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'server-src')))
+import downsample
+import argparse
+import utils
+import time
+
+parser = argparse.ArgumentParser(description="Measure rows/sec and payload size for the dashboard's chart data "
+                                             "(downsample.downsample_rows, utils.pack_columns, utils.columns_to_json).",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-n", "--rows", nargs='+', default=[10000, 100000, 1000000], help="Row counts to time.")
+parser.add_argument("-i", "--interval", default=2, help="Seconds between generated readings.")
+parser.add_argument("-p", "--points", default=800, help="Points per device after downsampling (the server's CHART_POINTS).")
+parser.add_argument("-m", "--method", default='lttb', choices=sorted(downsample.METHODS), help="Downsampling method.")
+
+args = parser.parse_args()
+config = vars(args)
+
+DEVICES = ('ph', 'ec', 'water_temp_f', 'water_gallons')
+
+
+def make_rows(n, interval):
+    # (ts, device_name, value) in UTC epoch microseconds, time ordered, as DB.iter_device_since(raw_ts=True) yields them
+    start = int(time.time() * 1000000) - int(interval * 1000000 * n // len(DEVICES))
+    return [(start + int(interval * 1000000) * (i // len(DEVICES)), DEVICES[i % len(DEVICES)], float(i))
+            for i in range(n)]
+
+
+def chart_payload(rows, points, method):
+    sampled = downsample.downsample_rows(rows, points, method)
+    return utils.columns_to_json(utils.pack_columns(sampled, devices=DEVICES))
+
+
+print(f"Packing {', '.join(DEVICES)} into chart columns ({config['method']}, {config['points']} points per device)")
+print('Rows'.rjust(9) + ' ' + 'Rows/sec'.rjust(14) + ' ' + 'Seconds'.rjust(9) + ' ' + 'Payload bytes'.rjust(14))
+print("==================================================")
+for n in config['rows']:
+    rows = make_rows(int(n), float(config['interval']))
+    start = time.perf_counter()
+    payload = chart_payload(rows, int(config['points']), config['method'])
+    elapsed = time.perf_counter() - start
+    print(f"{len(rows):9d} {len(rows) / elapsed:14.1f} {elapsed:9.3f} {len(payload):14d}")
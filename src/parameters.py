@@ -19,7 +19,27 @@ NUTE_4_RATE = 66.4
 RES_LEVEL__SLOPE = 7.214600210080451
 RES_LEVEL__INTERCEPT = -11.579335353873379
 CYCLE_DURATION = 900
+# Read independent sensors at the same time (see cycle_engine.py); False walks them one by one
+CONCURRENT_SENSOR_READS = True
+# Sample each sensor on its own period (seconds) instead of all of them every CYCLE_DURATION
+SAMPLE_SCHEDULER = True
+SAMPLE_PERIODS = {"ph": 900, "ec": 900, "water_height": 300, "water_temp_f": 1800}
+# After a control acts, read the sensors it disturbs every period seconds for duration seconds:
+# {control name: (sensor names, period, duration)}
+SAMPLE_BURSTS = {"pH Up": (("ph",), 30, 600),
+                 "pH Down": (("ph",), 30, 600),
+                 "FloraGro": (("ec", "ph"), 30, 600),
+                 "FloraMicro": (("ec", "ph"), 30, 600),
+                 "FloraBloom": (("ec", "ph"), 30, 600),
+                 "CALiMAGic": (("ec", "ph"), 30, 600),
+                 "solenoid": (("water_height", "ec", "ph"), 10, 300)}
+RAW_RETENTION_DAYS = 90
 
 DB_FILENAME = "/data/db/device_data.db"
 LOG_FILENAME = "/data/logs/device_job.log"
-FLAG_PATH = "/data/flags/request_flags.json"
\ No newline at end of file
+COMMANDS_DB_FILENAME = "/data/db/commands.db"
+# The web server wakes the device loop through this socket; the command queue is still polled as a fallback
+COMMAND_SOCKET_PATH = "/data/flags/commands.sock"
+COMMAND_POLL_SECONDS = 5
+# On a tmpfs shared with the server container (see start_devices.sh), so frequent saves never touch the SD card
+METRICS_PATH = "/metrics/device_metrics.json"
\ No newline at end of file
@@ -1,19 +1,51 @@
-from parameters import LOG_FILENAME, CYCLE_DURATION, DB_FILENAME
-from state_machine import sensor_state_machine, request_monitor
+from parameters import LOG_FILENAME, CYCLE_DURATION, DB_FILENAME, RAW_RETENTION_DAYS, SAMPLE_SCHEDULER, SAMPLE_PERIODS
+from state_machine import sensor_state_machine, request_monitor, sampling_scheduler, DB
 import logging
 import time
 
 logging.basicConfig(format='%(asctime)s %(message)s', filename=LOG_FILENAME, level=logging.INFO)
 
 logging.info("\\\\\\\\\\\\\\\\\\\\\\\\ Prepare to being recording device data ////////////")
-logging.info(f"Recording period: {CYCLE_DURATION}s")
+if SAMPLE_SCHEDULER:
+    logging.info(f"Sampling periods: {SAMPLE_PERIODS}")
+else:
+    logging.info(f"Recording period: {CYCLE_DURATION}s")
 logging.info(f"Using DB file:    {DB_FILENAME}")
 logging.info(f"Logs recorded in: {LOG_FILENAME}s")
+logging.info(f"Raw data kept for: {RAW_RETENTION_DAYS} days")
 logging.info("Begin recording...")
 
-while True:
-    cycle_start_time = time.time()
-    sensor_data = sensor_state_machine.cycle()
-    cycle_time = time.time() - cycle_start_time
+last_retention_time = 0
 
-    request_monitor.watch(sensor_data, cycle_time)
+
+def apply_retention(now):
+    # Once a day, move raw history past the retention window into the archive
+    global last_retention_time
+    if now - last_retention_time > 86400:
+        try:
+            archived = DB.apply_retention(RAW_RETENTION_DAYS)
+            logging.info(f"Archived {archived} rows older than {RAW_RETENTION_DAYS} days")
+        except Exception as e:
+            logging.error(f"Retention error: {e}")
+        last_retention_time = now
+
+
+if SAMPLE_SCHEDULER:
+    while True:
+        due = sampling_scheduler.pop_due()
+        cycle_time = None
+        if due:
+            cycle_start_time = time.monotonic()
+            sensor_state_machine.cycle(due)
+            cycle_time = time.monotonic() - cycle_start_time
+        apply_retention(time.time())
+        request_monitor.watch_schedule(cycle_time)
+
+else:
+    while True:
+        cycle_start_time = time.monotonic()
+        sensor_data = sensor_state_machine.cycle()
+        cycle_time = time.monotonic() - cycle_start_time
+        apply_retention(time.time())
+        # Waits for the next cycle boundary, handling requests meanwhile
+        request_monitor.watch(sensor_data, cycle_time)
@@ -0,0 +1,129 @@
+import heapq
+import logging
+import time
+import sys
+import os
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')))
+from metrics.registry import METRICS
+
+
+class SamplingScheduler:
+    """Decides which sensors are due for a reading, from a heap of (due time, sensor name).
+
+    Each sensor has its own period, and is rescheduled from when it was due
+    rather than from when it was read, so samples don't drift. Like CycleClock,
+    every sensor is read straight away, then on wall-clock multiples of its
+    period (:00, :15, :30 and :45 for 900 s). trigger(control)
+    starts a burst for the sensors that control disturbs (from bursts, as
+    {control name: (sensor names, period, duration)}): they are read every
+    burst period for the next duration seconds, then fall back to their own.
+    Times are time.monotonic().
+    """
+    def __init__(self, periods, bursts=None):
+        self.periods = dict(periods)
+        self.bursts = dict(bursts or dict())
+        self._heap = []
+        # Each sensor's live due time; heap entries that don't match were superseded by a burst
+        self._due = dict()
+        self._burst_until = dict()
+
+        now = time.monotonic()
+        # Monotonic time of the Unix epoch; readings are due this plus whole periods
+        self._epoch = now - time.time()
+        for name in self.periods:
+            self._schedule(name, now)
+
+    def _next_boundary(self, after, period):
+        # The tolerance keeps float error from returning a boundary equal to after
+        periods = (after - self._epoch) // period + 1
+        if self._epoch + periods * period - after < period * 1e-9:
+            periods += 1
+        return self._epoch + periods * period
+
+    def _schedule(self, name, due):
+        self._due[name] = due
+        heapq.heappush(self._heap, (due, name))
+
+    def period(self, name, now=None):
+        now = now if now is not None else time.monotonic()
+        burst_period, until = self._burst_until.get(name, (None, 0))
+        if now < until:
+            return min(burst_period, self.periods[name])
+        return self.periods[name]
+
+    def pop_due(self):
+        """Names of the sensors due now, each rescheduled for its next reading."""
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            at, name = heapq.heappop(self._heap)
+            if self._due.get(name) != at:
+                continue
+            due.append(name)
+            # A request handled near the due time (mixing, a fill) can make a reading late
+            METRICS.observe('sample_lateness_seconds', now - at, sensor=name)
+            period = self.period(name, now)
+            next_at = self._next_boundary(at, period)
+            if next_at <= now:
+                # Fell a whole period behind (e.g. a long fill); skip the missed readings
+                skipped_to = self._next_boundary(now, period)
+                missed = round((skipped_to - next_at) / period)
+                next_at = skipped_to
+                logging.error(f"{name} sampling overran: skipped {missed} readings")
+                METRICS.inc('sample_overruns_total', missed, sensor=name)
+            self._schedule(name, next_at)
+        return due
+
+    def seconds_until_next(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - time.monotonic())
+
+    def trigger(self, control_name):
+        """Called by a control after it acts, e.g. a pump after dosing."""
+        if control_name not in self.bursts:
+            return
+        names, burst_period, duration = self.bursts[control_name]
+        now = time.monotonic()
+        for name in names:
+            if name not in self.periods:
+                continue
+            self._burst_until[name] = (burst_period, now + duration)
+            # Pull the next reading in, never push it back
+            if self._due[name] > now + burst_period:
+                self._schedule(name, now + burst_period)
+        logging.info(f"{control_name} acted: sampling {', '.join(names)} every {burst_period}s for {duration}s")
+
+
+class CycleClock:
+    """Fixed cycle boundaries on time.monotonic(), for the one-cycle-every-period loop.
+
+    Boundaries are absolute: each is one period after the last, not after
+    the cycle ended, so cycles neither drift nor stretch by however long
+    they (or the requests handled between them) took. They are phased to
+    wall-clock multiples of the period (:00, :15, :30 and :45 for 900 s), so
+    readings land on a regular grid; the first cycle runs straight away.
+    """
+    def __init__(self, period):
+        self.period = period
+        self.deadline = time.monotonic()
+        # Monotonic time of a wall-clock multiple of period; later boundaries are this plus k periods
+        self._phase = self.deadline + (-time.time()) % period
+
+    def lateness(self):
+        """Seconds since the current boundary, i.e. how late a cycle starting now is."""
+        return max(0, time.monotonic() - self.deadline)
+
+    def advance(self):
+        """Move to the next boundary still ahead, and return how many were missed on the way."""
+        now = time.monotonic()
+        periods = (now - self._phase) // self.period + 1
+        next_deadline = self._phase + periods * self.period
+        missed = max(0, round((next_deadline - self.deadline) / self.period) - 1)
+        self.deadline = next_deadline
+        return missed
+
+    def remaining(self):
+        return max(0, self.deadline - time.monotonic())
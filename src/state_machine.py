@@ -1,5 +1,7 @@
 from devices import (SolenoidDevice, MOSFETSwitchDevice, PeristalticPumpDevice, 
     AtlasSensor, MPRLSSensor, TempSensor, MultichannelSolidStateRelayDevice)
+from cycle_engine import CycleEngine, SensorTask
+from scheduler import SamplingScheduler, CycleClock
 import parameters as prm
 import logging
 import time
@@ -7,9 +9,15 @@ import sys
 import os
 sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')))
 from db.database import DeviceDatabaseHandler
-from flags.flag_utils import read_flag, set_flag
+from db.writer import AsyncDatabaseWriter
+from flags.command_queue import CommandQueue, CommandListener
+from metrics.registry import METRICS
 
+# Saved for the web server's /metrics endpoint
+METRICS.path = prm.METRICS_PATH
 DB = DeviceDatabaseHandler(prm.DB_FILENAME)
+# Sensors and controls write through this queue so they never wait on SQLite
+WRITER = AsyncDatabaseWriter(DB)
 
 
 class State:
@@ -34,6 +42,20 @@ class DeviceState(State):
         self.device = device
         self.db = database
         self.value = None
+        self.started = False
+
+    def start(self):
+        # Sensors with a slow conversion begin it here, so it runs while other states do
+        if hasattr(self.device, 'start'):
+            self.device.start()
+            self.started = True
+
+    def read(self, **kwargs):
+        # Collect what start() began, or take a whole reading now
+        if self.started:
+            self.started = False
+            return self.device.collect()
+        return self.device.read(**kwargs)
 
 
 class pH(DeviceState):
@@ -43,7 +65,7 @@ class pH(DeviceState):
 
     def run(self, silent=False):
         try:
-            self.value = self.device.read()
+            self.value = self.read()
             ph = round(float(self.value), 2)
 
             if not silent:
@@ -69,7 +91,7 @@ class EC(DeviceState):
 
     def run(self, silent=False):
         try:
-            self.value = self.device.read()
+            self.value = self.read()
             ec = int(round(float(self.value) / 2))
 
             if not silent:
@@ -95,7 +117,7 @@ class WaterHeight(DeviceState):
 
     def run(self, silent=False, **kwargs):
         try:
-            self.value = self.device.read(with_pressure=True, **kwargs)
+            self.value = self.read(with_pressure=True, **kwargs)
             gallons, pressure = self.value
 
             if not silent:
@@ -124,7 +146,7 @@ class WaterTemp(DeviceState):
 
     def run(self, silent=False):
         try:
-            self.value = self.device.read()
+            self.value = self.read()
             temp_f = self.value
 
             if not silent:
@@ -151,22 +173,35 @@ class StateMachine:
     def step(self):
         current_state_name = str(self.current_state)
         logging.info("Step: " + current_state_name)
-        result = self.current_state.run()
+        with METRICS.timer('sensor_step_seconds', state=current_state_name):
+            result = self.current_state.run()
         self.results[current_state_name] = result
         self.current_state = self.current_state.next(result)
 
 
 class SensorStateMachine(StateMachine):
     # Initialize static variables
-    ph = pH(prm.PH_ADDRESS, DB)
-    ec = EC(prm.EC_ADDRESS, DB)
+    ph = pH(prm.PH_ADDRESS, WRITER)
+    ec = EC(prm.EC_ADDRESS, WRITER)
     water_height = WaterHeight(prm.RES_LEVEL_SLOPE,
                                prm.RES_LEVEL__INTERCEPT,
-                               DB)
-    water_temp = WaterTemp(DB)
+                               WRITER)
+    water_temp = WaterTemp(WRITER)
 
-    def __init__(self):
+    def __init__(self, concurrent=prm.CONCURRENT_SENSOR_READS):
         super().__init__(SensorStateMachine.ph)
+        self.engine = None
+        if concurrent:
+            # The Atlas probes and the MPRLS level sensor are on the same physical I2C bus, driven
+            # through different libraries (atlas_i2c and busio) that don't coordinate, so they all
+            # share one lock; only the 1-wire temperature read overlaps them. That also keeps an
+            # EC read, which drives current through the water, from skewing a pH read. EC reads
+            # after temperature so it sees this cycle's water temperature once compensation is wired in.
+            self.engine = CycleEngine([SensorTask(self.ph, bus='i2c', timeout=15),
+                                       SensorTask(self.ec, bus='i2c', after=['water_temp_f'], timeout=15),
+                                       SensorTask(self.water_height, bus='i2c', timeout=10),
+                                       SensorTask(self.water_temp, bus='w1', timeout=5)],
+                                      WRITER)
 
     def query(self, device, silent=False, **kwargs):
         device = device.lower()
@@ -180,22 +215,38 @@ class SensorStateMachine(StateMachine):
 
         return None
 
-    def cycle(self):
+    def cycle(self, names=None):
+        # Every sensor, or just the named ones (e.g. those SamplingScheduler says are due)
         logging.info(">>>========= Begin new cycle =========<<<")
         self.current_state = self.initial_state
         self.results = dict()
-        while self.current_state is not None:
-            self.step()
+        # Commit the whole cycle's readings at once, under one timestamp
+        with WRITER.batch():
+            if self.engine is not None:
+                self.results = self.engine.run(names)
+            else:
+                # Temperature is on its own bus and pH goes first anyway, so both convert
+                # while the walk starts; EC is only triggered once pH is done
+                for state in (self.water_temp, self.ph):
+                    if names is None or str(state) in names:
+                        state.start()
+                while self.current_state is not None:
+                    if names is None or str(self.current_state) in names:
+                        self.step()
+                    else:
+                        self.current_state = self.current_state.next(None)
 
         return self.results
 
 
 class ReservoirSolenoid:
-    def __init__(self, pin, database):
+    def __init__(self, pin, database, on_change=None):
         self.device = SolenoidDevice(pin=pin, fail_open=True)
         self.db = database
         self.name = "solenoid"
         self.value = 0
+        # Called with the name after the reservoir is changed, e.g. SamplingScheduler.trigger
+        self.on_change = on_change
 
     def __str__(self):
         return self.name
@@ -228,6 +279,8 @@ class ReservoirSolenoid:
 
                 self.db.write_value("solenoid", 0)
                 logging.info(f"Solenoid closed")
+                if self.on_change is not None:
+                    self.on_change(self.name)
 
             except Exception as e:
                 logging.error(f"Solenoid close error: {e}")
@@ -235,10 +288,12 @@ class ReservoirSolenoid:
 
 
 class DosingPump:
-    def __init__(self, name, pin, ml_per_min, database):
+    def __init__(self, name, pin, ml_per_min, database, on_change=None):
         self.device = PeristalticPumpDevice(pin=pin, ml_per_min=ml_per_min)
         self.db = database
         self.name = name
+        # Called with the name after a dose, e.g. SamplingScheduler.trigger
+        self.on_change = on_change
 
     def __str__(self):
         return self.name
@@ -254,6 +309,8 @@ class DosingPump:
             logging.info(f"Dosing {ml} mL of {self.name}")
             self.device.dose(ml)
             self.db.write_value(self.name, ml)
+            if self.on_change is not None:
+                self.on_change(self.name)
 
         except Exception as e:
             logging.error(f"{self.name} dosing error: {e}")
@@ -300,58 +357,77 @@ class Controls:
 
 
 class RequestMonitor(State):
-    def __init__(self, cycle_duration=900, flag_path='', sensors=None, controls=None):
+    def __init__(self, cycle_duration=900, commands=None, sensors=None, controls=None, socket_path=None,
+                 scheduler=None):
         self.name = "sleep"
-        self.file_err_flag = False
-        # At first, assume a 7.7-second runtime (but get better data over time)
-        self.run_times = [7.7] * 11
         self.cycle_duration = cycle_duration
-        self.flag_path = flag_path
+        self.clock = CycleClock(cycle_duration)
+        self.commands = commands
         self.sensors = sensors
         self.controls = controls
-        self.db = DB
+        # With a SamplingScheduler, bursts re-read the sensors after an action instead of a whole cycle
+        self.scheduler = scheduler
+        self.db = WRITER
+        self.listener = self._listen(socket_path)
+
+        interrupted = self.commands.fail_interrupted()
+        if interrupted:
+            logging.error(f"Marked {interrupted} requests interrupted by the last shutdown as failed")
+
+    def _listen(self, socket_path):
+        # The web server pokes this socket after queueing a command; without it we just poll
+        if socket_path is None:
+            return None
+        try:
+            return CommandListener(socket_path)
+        except OSError as e:
+            logging.error(f'Could not listen for requests on {socket_path}, polling the command queue instead: {e}')
+            return None
 
     def __str__(self):
         return self.name
 
-    def _get_wait_time(self):
-        sorted_times = sorted(self.run_times)
-        mid_times = sorted_times[3:8]
-        mean_runtime = sum(mid_times) / len(mid_times)
-        logging.info(f"Mean runtime: {round(mean_runtime, 3)} seconds")
-        return max(0, self.cycle_duration - mean_runtime)
+    def wait_for_requests(self, wait_for, poll_time=prm.COMMAND_POLL_SECONDS, return_after_request=False):
+        """Handle requests until wait_for seconds have passed.
 
-    def wait_for_requests(self, wait_for, sleep_time=0.25):
-        stop_at = time.time() + wait_for - sleep_time
-        while time.time() < stop_at:
-            try:
-                flag, set_at = read_flag(self.flag_path)
-            except FileNotFoundError:
-                # Use this flag to ensure we don't log this error 4 times a second :]
-                if not self.file_err_flag:
-                    logging.error(f'Flag file not found at {self.flag_path}!')
-                    self.file_err_flag = True
-                flag = dict()
-            self.process_flag_requests(flag)
-            time.sleep(sleep_time)
-
-    def _update_flag(self, flag, device, action, key, value):
-        flag[device][action][key] = value
-        set_flag(self.flag_path, flag)
-        return flag
-
-    def process_flag_requests(self, flag):
-        new_requests = []
-
-        for device in flag:
-            for action, req in flag[device].items():
-                if req['status'] == 'request':
-                    logging.info(f"New request for {device}: {flag[device]}")
-                    new_requests.append((device, action, flag[device][action]['value']))
+        The web server wakes the listener socket after queueing a command, so
+        this mostly sleeps in select(). It still checks the queue every
+        poll_time seconds in case a wakeup is ever missed. With
+        return_after_request, returns as soon as a request has been handled.
+        """
+        stop_at = time.monotonic() + wait_for
+        while True:
+            if self.process_requests() and return_after_request:
+                return
+
+            remaining = stop_at - time.monotonic()
+            if remaining <= 0:
+                return
+            if self.listener is not None:
+                self.listener.wait(min(poll_time, remaining))
+            else:
+                time.sleep(min(poll_time, remaining))
+
+    def process_requests(self):
+        with METRICS.timer('command_poll_seconds'):
+            # A read-only check first, so idle polls never take the queue's write lock
+            if not self.commands.has_pending():
+                return False
+            commands = self.commands.claim()
 
-        if new_requests:
-            plan = self._build_plan(new_requests)
-            self.execute_plan(plan, flag)
+        new_requests = []
+        for command in commands:
+            logging.info(f"New request {command['command_id']}: {command['device']} {command['action']} {command['value']}")
+            new_requests.append((command['device'], command['action'], command['value'],
+                                 command['command_id'], command['created_at']))
+
+        plan = self._build_plan(new_requests)
+        # Whatever _build_plan left behind is nothing the device loop knows how to do
+        for (device, action, _, command_id, _) in new_requests:
+            logging.error(f"Unsupported request {command_id}: {device} {action}")
+            self.commands.complete(command_id, error=f'Unsupported request: {device} {action}')
+        self.execute_plan(plan)
+        return True
 
     def _build_plan(self, new_requests):
         """Here, we essentially just reorder the list of requests.
@@ -372,115 +448,161 @@ class RequestMonitor(State):
 
         O(n^2), triangular in n really, but n <= 9 so not worth optimizing :)
         """
-        optimal_order = [('level', 'empty'), ('level', 'set'), 
+        optimal_order = [('level', 'empty'), ('level', 'drain'), ('level', 'set'), 
                          ('level', 'fill'), ('ec', 'nute2'), ('ec', 'nute1'), 
                          ('ec', 'nute3'), ('ec', 'nute4'), ('ph', 'up'), 
                          ('ph', 'down')]
 
         plan = []
         for device, action in optimal_order:
-            for req in new_requests:
-                req_device, req_action, _ = req
+            for req in list(new_requests):
+                req_device, req_action = req[:2]
                 if device == req_device and action == req_action:
                     plan.append(req)
                     new_requests.remove(req)
 
         return plan
 
-    def execute_plan(self, plan, flag):
-        for (device, action, value) in plan:
-            took_action = False
-            mixin = False
-            # Water level controls
-            if device == 'level':
-                # Start by getting the current water level
-                current = self.sensors.query('level', silent=True)
-
-                # Add water
-                if (action == 'fill') or (action == 'set' and value > current):
-                    # Add water! :)
-                    try:
-                        latest_level = self.sensors.query('level', silent=True, 
+    def execute_plan(self, plan):
+        took_action = False
+        mixin = False
+        for i, (device, action, value, command_id, created_at) in enumerate(plan):
+            try:
+                took, mix = self._execute_request(device, action, value)
+            except Exception as e:
+                self.commands.complete(command_id, error=str(e))
+                # Don't leave the rest claimed forever; they ran in order for a reason
+                for skipped in plan[i + 1:]:
+                    self.commands.complete(skipped[3], error=f'Skipped: request {command_id} failed')
+                raise
+            took_action = took_action or took
+            mixin = max(mixin, mix)
+            self.commands.complete(command_id)
+            METRICS.observe('request_fulfillment_seconds', time.time() - created_at / 1000000, device=device, action=action)
+
+        if took_action and self.scheduler is None:
+            # Sleep for mixin, then update the sensor data
+            if mixin:
+                logging.info(f"Sleep for {mixin} seconds to allow for mixing")
+                time.sleep(mixin)
+            self.sensors.cycle()
+
+    def _execute_request(self, device, action, value):
+        # Returns whether anything physically changed, and how long to let it mix
+        took_action = False
+        mixin = False
+        # Water level controls
+        if device == 'level':
+            # Start by getting the current water level
+            current = self.sensors.query('level', silent=True)
+
+            # Add water
+            if (action == 'fill') or (action == 'set' and value > current):
+                # Add water! :)
+                try:
+                    latest_level = self.sensors.query('level', silent=True, 
+                                                      num_samples=3,
+                                                      num_trials=3)
+                    while latest_level < value:
+                        self.controls.solenoid.open()
+                        logging.info(f"Water level: {latest_level}")
+                        latest_level = self.sensors.query('level', 
+                                                          silent=True, 
                                                           num_samples=3,
                                                           num_trials=3)
-                        while latest_level < value:
-                            self.controls.solenoid.open()
-                            logging.info(f"Water level: {latest_level}")
-                            latest_level = self.sensors.query('level', 
-                                                              silent=True, 
-                                                              num_samples=3,
-                                                              num_trials=3)
-                        logging.info(f"Water level: {latest_level}")
+                    logging.info(f"Water level: {latest_level}")
 
-                    finally:
-                        self.controls.solenoid.close()
-                        # Let stuff mix and settle for a few seconds
-                        mixin = 10
-                        took_action = True
-                        
-                # Remove water
-                elif (action == 'drain') or (action == 'set' and value < current):
-                    # Turn on the drain pump
-                    logging.info("Activate drain pump relay")
-                    pass
-
-            elif device == 'ec':
-                if action == 'nute1':
-                    logging.info("EC plan executed for FloraGro :)")
-                elif action == 'nute2':
-                    self.controls.nute2.dose(value)
-                    took_action = True
-                    mixin = 10
-                elif action == 'nute3':
-                    self.controls.nute3.dose(value)
-                    took_action = True
+                finally:
+                    self.controls.solenoid.close()
+                    # Let stuff mix and settle for a few seconds
                     mixin = 10
-                elif action == 'nute4':
-                    self.controls.nute4.dose(value)
                     took_action = True
-                    mixin = 10
 
-            elif device == 'ph':
-                if action == 'up':
-                    self.controls.ph_up.dose(value)
-                    took_action = True
-                    mixin = 10
-                elif action == 'down':
-                    self.controls.ph_down.dose(value)
-                    took_action = True
-                    mixin = 10
+            # Remove water
+            elif (action == 'drain') or (action == 'set' and value < current):
+                # Turn on the drain pump
+                logging.info("Activate drain pump relay")
+                pass
+
+        elif device == 'ec':
+            if action == 'nute1':
+                logging.info("EC plan executed for FloraGro :)")
+            elif action == 'nute2':
+                self.controls.nute2.dose(value)
+                took_action = True
+                mixin = 10
+            elif action == 'nute3':
+                self.controls.nute3.dose(value)
+                took_action = True
+                mixin = 10
+            elif action == 'nute4':
+                self.controls.nute4.dose(value)
+                took_action = True
+                mixin = 10
+
+        elif device == 'ph':
+            if action == 'up':
+                self.controls.ph_up.dose(value)
+                took_action = True
+                mixin = 10
+            elif action == 'down':
+                self.controls.ph_down.dose(value)
+                took_action = True
+                mixin = 10
+
+        return took_action, mixin
+
+    def _record_cycle(self, cycle_time):
+        # Shared by the fixed-cycle and scheduled loops, so both report the same metrics
+        if cycle_time is not None:
+            logging.info(f"Last sensor cycle took {round(cycle_time, 3)} seconds")
+            logging.info(f"Database writer: {WRITER.stats()}")
+            METRICS.observe('cycle_seconds', cycle_time)
+        METRICS.set('writer_queue_depth', WRITER.queue_depth)
+        METRICS.set('writer_dropped', WRITER.dropped)
 
-            self._update_flag(flag, device, action, "status", "fulfilled")
+    def watch(self, sensor_data, cycle_time):
+        self._record_cycle(cycle_time)
 
-        if took_action:
-            # Sleep for mixin, then update the sensor data
-            if mixin:
-                logging.info(f"Sleep for {mixin} seconds to allow for mixing")
-                time.sleep(mixin)
-            self.sensors.cycle()
+        missed = self.clock.advance()
+        if missed:
+            logging.error(f"Cycle overran: skipped {missed} cycle boundaries")
+            METRICS.inc('cycle_overruns_total', missed)
 
-    def watch(self, sensor_data, cycle_time):
-        logging.info(f"Last sensor cycle took {round(cycle_time, 3)} seconds")
-        self.run_times = [cycle_time] + self.run_times[:10]
-        self.file_err_flag = False
-        wait_for = self._get_wait_time()
-        logging.info(f"Monitor for requests for {wait_for} seconds...")
+        wait_for = self.clock.remaining()
+        logging.info(f"Monitor for requests for {round(wait_for, 3)} seconds...")
         self.wait_for_requests(wait_for)
 
+        # A request handled near the boundary (mixing, a fill) can run past it
+        lateness = self.clock.lateness()
+        METRICS.observe('cycle_lateness_seconds', lateness)
+        if lateness > 1:
+            logging.warning(f"Next cycle starts {round(lateness, 3)} seconds late")
+
+    def watch_schedule(self, cycle_time=None):
+        """watch() for the scheduled loop: cycle_time is None when no sensor was due."""
+        self._record_cycle(cycle_time)
+        # Handle requests until the next sensor is due; a request may start a burst, so then check again
+        self.wait_for_requests(self.scheduler.seconds_until_next(), return_after_request=True)
+
 
 relays_device = MultichannelSolidStateRelayDevice(address=prm.RELAY_ADDRESS, 
                                                   channels=4)
 sensor_state_machine = SensorStateMachine()
-controls = Controls(solenoid=ReservoirSolenoid(prm.SOLENOID_PIN, DB),
-                    ph_up=DosingPump("pH Up", prm.PH_UP_PIN, prm.PH_UP_RATE, DB),
-                    ph_down=DosingPump("pH Down", prm.PH_DOWN_PIN, prm.PH_DOWN_RATE, DB),
-                    nute1=DosingPump("FloraGro", prm.NUTE_1_PIN, prm.NUTE_1_RATE, DB),
-                    nute2=DosingPump("FloraMicro", prm.NUTE_2_PIN, prm.NUTE_2_RATE, DB),
-                    nute3=DosingPump("FloraBloom", prm.NUTE_3_PIN, prm.NUTE_3_RATE, DB),
-                    nute4=DosingPump("CALiMAGic", prm.NUTE_4_PIN, prm.NUTE_4_RATE, DB),
-                    drain=Relay(relays_device, 1, "Drain Pump", DB),
-                    topfeed=Relay(relays_device, 2, "Top Feed Pump", DB),
-                    veg_light=Relay(relays_device, 3, "Veg Lights", DB),
-                    flower_light=Relay(relays_device, 4, "Flower Lights", DB))
-request_monitor = RequestMonitor(prm.CYCLE_DURATION, prm.FLAG_PATH, 
-                                 sensor_state_machine, controls)
\ No newline at end of file
+# Only drives sampling when run.py uses it (prm.SAMPLE_SCHEDULER); controls report to it either way
+sampling_scheduler = SamplingScheduler(prm.SAMPLE_PERIODS, prm.SAMPLE_BURSTS)
+controls = Controls(solenoid=ReservoirSolenoid(prm.SOLENOID_PIN, WRITER, on_change=sampling_scheduler.trigger),
+                    ph_up=DosingPump("pH Up", prm.PH_UP_PIN, prm.PH_UP_RATE, WRITER, on_change=sampling_scheduler.trigger),
+                    ph_down=DosingPump("pH Down", prm.PH_DOWN_PIN, prm.PH_DOWN_RATE, WRITER, on_change=sampling_scheduler.trigger),
+                    nute1=DosingPump("FloraGro", prm.NUTE_1_PIN, prm.NUTE_1_RATE, WRITER, on_change=sampling_scheduler.trigger),
+                    nute2=DosingPump("FloraMicro", prm.NUTE_2_PIN, prm.NUTE_2_RATE, WRITER, on_change=sampling_scheduler.trigger),
+                    nute3=DosingPump("FloraBloom", prm.NUTE_3_PIN, prm.NUTE_3_RATE, WRITER, on_change=sampling_scheduler.trigger),
+                    nute4=DosingPump("CALiMAGic", prm.NUTE_4_PIN, prm.NUTE_4_RATE, WRITER, on_change=sampling_scheduler.trigger),
+                    drain=Relay(relays_device, 1, "Drain Pump", WRITER),
+                    topfeed=Relay(relays_device, 2, "Top Feed Pump", WRITER),
+                    veg_light=Relay(relays_device, 3, "Veg Lights", WRITER),
+                    flower_light=Relay(relays_device, 4, "Flower Lights", WRITER))
+request_monitor = RequestMonitor(prm.CYCLE_DURATION, CommandQueue(prm.COMMANDS_DB_FILENAME),
+                                 sensor_state_machine, controls,
+                                 socket_path=prm.COMMAND_SOCKET_PATH,
+                                 scheduler=sampling_scheduler if prm.SAMPLE_SCHEDULER else None)
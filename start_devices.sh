@@ -13,7 +13,8 @@ fi
 docker stop devices
 docker rm devices
 docker build -f /home/pi/DeepCultureMonitor/build/Dockerfile . -t devices
-docker run -d -v /home/pi/DeepCultureMonitor/data/:/data/ --privileged --restart=unless-stopped --name devices devices
+# Metrics are saved every few seconds, so they go to a host tmpfs (shared with the server) rather than the SD card
+docker run -d -v /home/pi/DeepCultureMonitor/data/:/data/ -v /dev/shm/deep-culture-metrics/:/metrics/ --privileged --restart=unless-stopped --name devices devices
 
 if [[ "$CHANGEDDIRS" = true ]]
 then